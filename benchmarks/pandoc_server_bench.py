@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+
+# Compares per-build latency of running pandoc as a subprocess against
+# sending the same conversion to a persistent pandoc-server.
+#
+#   python3 benchmarks/pandoc_server_bench.py [builds] [paragraphs]
+
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import pandoc_server  # noqa: E402
+
+
+def report(name: str, timings) -> None:
+    print('%-12s median %7.1f ms   p95 %7.1f ms' % (
+        name,
+        statistics.median(timings) * 1000,
+        sorted(timings)[int(len(timings) * .95) - 1] * 1000,
+    ))
+
+
+def main(builds: int, paragraphs: int) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        input_name = os.path.join(directory, 'input.md')
+        output_name = os.path.join(directory, 'output.html')
+        with open(input_name, 'w') as fd:
+            for i in range(paragraphs):
+                fd.write('# Section %d\n\nSome *text* for %d.\n\n' % (i, i))
+
+        timings = []
+        for _ in range(builds):
+            start = time.perf_counter()
+            subprocess.call(['pandoc', '-s', '-o', output_name, input_name])
+            timings.append(time.perf_counter() - start)
+        report('subprocess', timings)
+
+        server = pandoc_server.getServer()
+        request = pandoc_server.makeRequest(['-s'], output_name, input_name)
+        if request is None or server.convert(request) is None:
+            print('pandoc-server unavailable', file=sys.stderr)
+            return
+        timings = []
+        for _ in range(builds):
+            start = time.perf_counter()
+            request = pandoc_server.makeRequest(
+                ['-s'], output_name, input_name)
+            assert request is not None
+            server.convert(request)
+            timings.append(time.perf_counter() - start)
+        report('server', timings)
+
+
+if __name__ == '__main__':
+    try:
+        subprocess.call(['pandoc', '--version'], stdout=subprocess.DEVNULL)
+    except FileNotFoundError:
+        print('pandoc not installed', file=sys.stderr)
+        exit(1)
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 50,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 100,
+    )
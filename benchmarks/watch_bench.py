@@ -0,0 +1,166 @@
+#!/usr/bin/python3
+
+# Measures the cost of change detection and build scheduling on a generated
+# tree of documents, with stub commands standing in for pdflatex and pandoc.
+#
+#   python3 benchmarks/watch_bench.py [files] [megabytes] [documents]
+#                                     [build seconds]
+#
+# For each backend it reports how long a write takes to be noticed, how much
+# CPU an idle watch burns per minute and how much memory each watched file
+# costs, followed by the build throughput of the worker pool.
+
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from typing import List, Callable
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import shared_watch  # noqa: E402
+
+IDLE_SECONDS = 5
+POLL_INTERVAL = .5
+LATENCY_SAMPLES = 5
+
+
+class StubBuild(shared_watch.Build):
+    def __init__(self, recipe, files: List[str], seconds: float = 0) -> None:
+        super().__init__(recipe)
+        for file_name in files:
+            self.addWatchedFile(file_name)
+        self.seconds = seconds
+        self.build_steps = [self.stub]
+
+    def stub(self):
+        self.call(['sleep', str(self.seconds)])
+
+
+def makeTree(directory: str, files: int, megabytes: float) -> List[str]:
+    names = []
+    chunk = os.urandom(64 * 1024)
+    for i in range(files):
+        name = os.path.join(directory, 'file%04d.tex' % i)
+        with open(name, 'wb') as fd:
+            for _ in range(max(1, int(megabytes * 16))):
+                fd.write(chunk)
+        names.append(name)
+    return names
+
+
+def hashEverything(build: shared_watch.Build) -> bool:
+    # What FileWatch used to do: look at every byte on every check.
+    for watch in build.watchedFiles:
+        shared_watch.digestFile(watch.file_name)
+    return build.hasAnythingChanged()
+
+
+def checker(backend: str) -> Callable[[shared_watch.Build], bool]:
+    if backend == 'hash':
+        return hashEverything
+    return shared_watch.Build.hasAnythingChanged
+
+
+def detector(backend: str, build: shared_watch.Build) -> Callable[[], None]:
+    if backend == 'inotify':
+        def detect() -> None:
+            while not build.waitForChange():
+                pass
+            build.hasAnythingChanged()
+    else:
+        check = checker(backend)
+
+        def detect() -> None:
+            while not check(build):
+                time.sleep(POLL_INTERVAL)
+    return detect
+
+
+def benchBackend(backend: str, names: List[str], auxdir: str) -> None:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    build = StubBuild({'auxdir': auxdir, 'poll': backend != 'inotify'},
+                      names)
+    memory = (tracemalloc.get_traced_memory()[0] - before) / len(names)
+    tracemalloc.stop()
+    if backend == 'inotify' and \
+            shared_watch.fileIndex.isPolled(build):
+        print('%-8s unavailable' % backend)
+        build.close()
+        return
+    detect = detector(backend, build)
+
+    latencies = []
+    for i in range(LATENCY_SAMPLES):
+        target = names[i % len(names)]
+        written = []  # type: List[float]
+
+        def write() -> None:
+            time.sleep(.05)
+            # Taken before writing: the event can be noticed, and detect()
+            # return, before the file is even closed.
+            written.append(time.perf_counter())
+            with open(target, 'ab') as fd:
+                fd.write(b'%d\n' % i)
+        writer = threading.Thread(target=write)
+        writer.start()
+        detect()
+        noticed = time.perf_counter()
+        writer.join()
+        latencies.append(noticed - written[0])
+
+    # Idle: nothing changes, so only the backend's own overhead shows up.
+    cpu = time.process_time()
+    deadline = time.monotonic() + IDLE_SECONDS
+    while time.monotonic() < deadline:
+        if backend == 'inotify':
+            build.waitForChange(deadline - time.monotonic())
+        else:
+            checker(backend)(build)
+            time.sleep(POLL_INTERVAL)
+    idle_cpu = (time.process_time() - cpu) * 60 / IDLE_SECONDS
+    build.close()
+
+    print('%-8s detect %8.1f ms   idle cpu %7.3f s/min   %7.0f B/file' % (
+        backend, max(latencies) * 1000, idle_cpu, memory))
+
+
+def benchThroughput(
+        names: List[str], documents: int, seconds: float, auxdir: str,
+        ) -> None:
+    builds = [StubBuild({'auxdir': auxdir, 'poll': True}, names[:1], seconds)
+              for _ in range(documents)]
+    pool = shared_watch.BuildPool(os.cpu_count() or 1)
+    started = time.perf_counter()
+    for build in builds:
+        pool.submit(build)
+    pool.join()
+    elapsed = time.perf_counter() - started
+    print('pool     %d builds in %.2f s, %.1f builds/s' % (
+        documents, elapsed, documents / elapsed))
+
+
+def main(
+        files: int, megabytes: float, documents: int, seconds: float,
+        ) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        names = makeTree(directory, files, megabytes)
+        auxdir = os.path.join(directory, 'aux')
+        print('%d files of %.1f MB, %d documents' % (
+            files, megabytes, documents))
+        for backend in ('hash', 'stat', 'inotify'):
+            benchBackend(backend, names, auxdir)
+        benchThroughput(names, documents, seconds, auxdir)
+
+
+if __name__ == '__main__':
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 50,
+        float(sys.argv[2]) if len(sys.argv) > 2 else 1,
+        int(sys.argv[3]) if len(sys.argv) > 3 else 20,
+        float(sys.argv[4]) if len(sys.argv) > 4 else .2,
+    )
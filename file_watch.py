@@ -2,19 +2,94 @@
 
 import latex_watch
 import pandoc_watch
+import shared_watch
+import watch_backends
+import watch_daemon
+import fnmatch
+import signal
 import sys
 import os
-from threading import Thread
-from typing import List, Tuple, Dict, Any, Callable
+from typing import List, Tuple, Dict, Any, Callable, Optional, Set
 
 ProcessedArgs = Dict[str, Any]
-MainForFileMethod = Callable[[ProcessedArgs], None]
-FilePair = Tuple[MainForFileMethod, ProcessedArgs]
+PrepareForFileMethod = Callable[[ProcessedArgs], shared_watch.Watch]
+FilePair = Tuple[PrepareForFileMethod, ProcessedArgs]
+
+# Directories never worth searching for documents, on top of hidden ones and
+# the patterns listed in IGNORE_FILE.
+_IGNORED_DIRS = {'node_modules', '__pycache__', 'venv'}
+IGNORE_FILE = '.watchignore'
+
+
+def readIgnorePatterns(root: str = '.') -> List[str]:
+    try:
+        with open(os.path.join(root, IGNORE_FILE)) as fd:
+            return [line.strip() for line in fd
+                    if line.strip() and not line.startswith('#')]
+    except FileNotFoundError:
+        return []
+
+
+def isIgnoredDir(name: str, patterns: List[str]) -> bool:
+    return name[0] == '.' or name in _IGNORED_DIRS or \
+        any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+
+def findSwapFiles(
+        root: str,
+        patterns: List[str],
+        ) -> Tuple[List[str], List[str]]:
+    # Returns the swap files under root and every directory searched.
+    swaps = []  # type: List[str]
+    directories = []  # type: List[str]
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        directories.append(directory)
+        try:
+            it = os.scandir(directory)
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if not isIgnoredDir(entry.name, patterns):
+                        stack.append(entry.path)
+                elif isSwapFile(entry.name):
+                    swaps.append(os.path.normpath(entry.path))
+    return swaps, directories
+
+
+def isSwapFile(file_name: str) -> bool:
+    return (len(file_name) > 9 and file_name[0] == '.' and
+            file_name[-8:] == '.tex.swp') or \
+        (len(file_name) > 8 and file_name[0] == '.' and
+            file_name[-7:] == '.md.swp')
+
+
+def documentForSwapFile(swap: str) -> str:
+    return os.path.join(os.path.dirname(swap), os.path.basename(swap)[1:-4])
+
+
+def pairForSwapFile(
+        argv: List[str], swap: str, cwd: Optional[str] = None,
+        ) -> FilePair:
+    file_name = documentForSwapFile(swap)
+    if file_name[-4:] == '.tex':
+        return (
+            latex_watch.prepare_for_file,
+            latex_watch.processargs(argv + [file_name], cwd)
+        )
+    return (
+        pandoc_watch.prepare_for_file,
+        pandoc_watch.processargs(argv + [file_name], cwd)
+    )
 
 
 def processargs(
-        argv: List[str],
+        argv: List[str], cwd: Optional[str] = None,
         ) -> List[FilePair]:
+    # cwd is where a daemon client was run from, see watch_daemon.
     output = list()  # type: List[FilePair]
     dashArguments = False
     markdownFiles = False
@@ -33,16 +108,16 @@ def processargs(
             if '.md' in arg[-3:]:
                 output.append(
                         (
-                            pandoc_watch.main_for_file,
-                            pandoc_watch.processargs([argv[0], arg])
+                            pandoc_watch.prepare_for_file,
+                            pandoc_watch.processargs([argv[0], arg], cwd)
                         )
                 )
 
             elif '.tex' in arg[-4:]:
                 output.append(
                         (
-                            latex_watch.main_for_file,
-                            latex_watch.processargs([argv[0], arg])
+                            latex_watch.prepare_for_file,
+                            latex_watch.processargs([argv[0], arg], cwd)
                         )
                 )
 
@@ -51,48 +126,210 @@ def processargs(
     elif markdownFiles:
         output.append(
                 (
-                    pandoc_watch.main_for_file,
-                    pandoc_watch.processargs(argv)
+                    pandoc_watch.prepare_for_file,
+                    pandoc_watch.processargs(argv, cwd)
                 )
         )
 
     elif latexFiles:
         output.append(
                 (
-                    latex_watch.main_for_file,
-                    latex_watch.processargs(argv)
+                    latex_watch.prepare_for_file,
+                    latex_watch.processargs(argv, cwd)
                 )
         )
     else:
         # No file name given
-        for file_name in os.listdir():
-            if len(file_name) > 9 and file_name[0] == '.' and \
-                    file_name[-8:] == '.tex.swp':
-                output.append(
-                        (
-                            latex_watch.main_for_file,
-                            latex_watch.processargs(argv + [file_name[1:-4]])
-                        )
-                )
-
-            if len(file_name) > 8 and file_name[0] == '.' and \
-                    file_name[-7:] == '.md.swp':
-                output.append(
-                        (
-                            pandoc_watch.main_for_file,
-                            pandoc_watch.processargs(argv + [file_name[1:-4]])
-                        )
-                )
+        swaps, _ = findSwapFiles(os.curdir, readIgnorePatterns())
+        for swap in swaps:
+            output.append(pairForSwapFile(argv, swap, cwd))
     return output
 
 
-def launchWatches(mainsAndArgs: List[FilePair]) -> None:
+def isDiscovering(argv: List[str]) -> bool:
+    return not any(arg[-3:] == '.md' or arg[-4:] == '.tex'
+                   for arg in argv[1:])
+
+
+class SwapDiscovery:
+    # Keeps an index of editor sessions, by document, and starts watching
+    # documents whose swap files appear after startup.
+    def __init__(
+            self, argv: List[str],
+            loop: shared_watch.WatchLoop,
+            ) -> None:
+        self.argv = argv
+        self.loop = loop
+        self.patterns = readIgnorePatterns()
+        self.sessions = {}  # type: Dict[str, shared_watch.Watch]
+        self.directories = []  # type: List[str]
+        self.watcher = watch_backends.newWatcher()
+        self.listening = False
+        _, directories = findSwapFiles(os.curdir, self.patterns)
+        for directory in directories:
+            self._watchDirectory(directory)
+        loop.addListener(self.watcher, self.pathsChanged)
+        self.listening = True
+
+    def _watchDirectory(self, directory: str) -> None:
+        self.directories.append(directory)
+        if isinstance(self.watcher, watch_backends.PollWatcher):
+            self.watcher.addDirectory(directory)
+            return
+        try:
+            if watch_backends.needsPolling(os.path.join(directory, '.')):
+                raise OSError()
+            self.watcher.addDirectory(directory)
+        except OSError:
+            # Out of inotify watches most likely, or on a network
+            # filesystem; polling still finds everything.
+            if self.listening:
+                self.loop.removeListener(self.watcher)
+            self.watcher.close()
+            self.watcher = watch_backends.PollWatcher()
+            for watched in self.directories:
+                self.watcher.addDirectory(watched)
+            if self.listening:
+                self.loop.addListener(self.watcher, self.pathsChanged)
+
+    def addSession(self, file_name: str, watch: shared_watch.Watch) -> None:
+        self.sessions[os.path.normpath(file_name)] = watch
+
+    def _swapFileSeen(self, swap: str) -> None:
+        # Looked up before making a pair, since that sets up a whole build.
+        file_name = os.path.normpath(documentForSwapFile(swap))
+        watch = self.sessions.get(file_name)
+        if watch is not None and self.loop.isWatching(watch):
+            return
+        pair = pairForSwapFile(self.argv, swap)
+        watch = pair[0](pair[1])
+        self.sessions[file_name] = watch
+        self.loop.add(watch)
+
+    def pathsChanged(self, paths: Optional[Set[str]]) -> None:
+        if paths is None:
+            swaps, _ = findSwapFiles(os.curdir, self.patterns)
+            for swap in swaps:
+                self._swapFileSeen(swap)
+            return
+        for path in sorted(paths):
+            path = os.path.relpath(path)
+            if os.path.isdir(path) and \
+                    not isIgnoredDir(os.path.basename(path), self.patterns):
+                swaps, directories = findSwapFiles(path, self.patterns)
+                for directory in directories:
+                    self._watchDirectory(directory)
+                for swap in swaps:
+                    self._swapFileSeen(swap)
+            elif isSwapFile(os.path.basename(path)) and \
+                    os.path.lexists(path):
+                self._swapFileSeen(path)
+
+
+def launchWatches(
+        mainsAndArgs: List[FilePair],
+        discoverFrom: Optional[List[str]] = None,
+        ) -> None:
+    # One loop owns every watch, and its pool caps how many builds run at
+    # once no matter how many documents are open.
+    jobs = max([mainAndArgPair[1]['jobs'] or 0
+                for mainAndArgPair in mainsAndArgs] or [0])
+    loop = shared_watch.WatchLoop(jobs or None)
+    discovery = None  # type: Optional[SwapDiscovery]
+    if discoverFrom is not None:
+        discovery = SwapDiscovery(discoverFrom, loop)
     for mainAndArgPair in mainsAndArgs:
-        Thread(
-            target=mainAndArgPair[0],
-            args=tuple([mainAndArgPair[1]]),
-            ).start()
+        if os.getenv('VIM', False) and shared_watch.sendTrigger(
+                mainAndArgPair[1]['auxdir'], mainAndArgPair[1]['file']):
+            # Already watched by another process, which builds it now.
+            continue
+        watch = mainAndArgPair[0](mainAndArgPair[1])
+        if discovery is not None:
+            discovery.addSession(mainAndArgPair[1]['file'], watch)
+        loop.add(watch)
+    loop.run()
+
+
+def runDaemon(argv: List[str]) -> None:
+    jobs = None  # type: Optional[int]
+    for i, arg in enumerate(argv):
+        if arg.startswith('--jobs='):
+            jobs = int(arg.split('=')[1])
+        elif arg in ('--jobs', '-j') and i + 1 < len(argv):
+            jobs = int(argv[i + 1])
+    if jobs is not None and jobs < 1:
+        print("--jobs must be at least 1", file=sys.stderr)
+        exit(1)
+    loop = shared_watch.WatchLoop(jobs)
+    daemon = watch_daemon.WatchDaemon(loop, processargs)
+    # Leave through the finally below, so the socket is removed.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        loop.run()
+    finally:
+        daemon.close()
+
+
+def printDocuments(reply: Dict[str, Any]) -> None:
+    if not reply.get('ok'):
+        print(reply.get('error', 'file_watch daemon refused the request.'),
+              file=sys.stderr)
+        exit(1)
+    for document in reply['documents']:
+        if isinstance(document, str):
+            print(document)
+            continue
+        print('%-8s %s%s' % (
+            document['state'] if document['watching'] else 'stopped',
+            document['file'],
+            '\n    ' + document['error'] if document['error'] else ''))
+
+
+def runClient(argv: List[str]) -> bool:
+    # Hands the documents to a running daemon. Returns False if there
+    # isn't one, to watch them in this process instead.
+    cwd = os.getcwd()
+    if '--status' in argv:
+        message = {'command': 'status'}  # type: Dict[str, Any]
+    elif '--unregister' in argv:
+        message = {'command': 'unregister', 'files': [
+            os.path.join(cwd, arg) for arg in argv[1:] if arg[0] != '-']}
+    elif isDiscovering(argv):
+        swaps, _ = findSwapFiles(os.curdir, readIgnorePatterns())
+        reply = None
+        for swap in swaps:
+            reply = watch_daemon.request({
+                'command': 'register',
+                'argv': watch_daemon.absoluteArgv(
+                    argv + [documentForSwapFile(swap)], cwd),
+                'cwd': cwd,
+                'trigger': bool(os.getenv('VIM', False)),
+            })
+            if reply is None:
+                return False
+            printDocuments(reply)
+        return reply is not None or \
+            watch_daemon.request({'command': 'ping'}) is not None
+    else:
+        message = {'command': 'register',
+                   'argv': watch_daemon.absoluteArgv(argv, cwd),
+                   'cwd': cwd,
+                   'trigger': bool(os.getenv('VIM', False))}
+    reply = watch_daemon.request(message)
+    if reply is None:
+        if message['command'] != 'register':
+            print("file_watch daemon not running.", file=sys.stderr)
+            exit(1)
+        return False
+    printDocuments(reply)
+    return True
 
 
 if __name__ == '__main__':
-    launchWatches(processargs(sys.argv))
+    if '--daemon' in sys.argv:
+        runDaemon(sys.argv)
+    elif not runClient(sys.argv):
+        launchWatches(
+            processargs(sys.argv),
+            sys.argv if isDiscovering(sys.argv) else None,
+        )
@@ -0,0 +1,184 @@
+import json
+import os
+import re
+import tempfile
+import threading
+from typing import List, Dict, Any, Optional, Set
+
+_CACHE_VERSION = 1
+
+_COMMAND = re.compile(
+    r'\\(input|include|subfile|bibliography|addbibresource|'
+    r'includegraphics|includepdf|usepackage|RequirePackage|documentclass)'
+    r'\*?\s*(?:\[[^\]]*\]\s*)*\{([^}]*)\}'
+)
+_COMMENT = re.compile(r'(?<!\\)%.*')
+
+# Extensions tried, in order, for arguments given without one.
+_EXTENSIONS = {
+    'input': ['.tex'],
+    'include': ['.tex'],
+    'subfile': ['.tex'],
+    'bibliography': ['.bib'],
+    'addbibresource': [],
+    'includegraphics': ['.pdf', '.png', '.jpg', '.jpeg', '.eps'],
+    'includepdf': ['.pdf'],
+    'usepackage': ['.sty'],
+    'RequirePackage': ['.sty'],
+    'documentclass': ['.cls'],
+}
+# Commands taking comma separated lists of names.
+_LISTS = {'bibliography', 'usepackage', 'RequirePackage'}
+# Files which can themselves pull in more dependencies.
+_SCANNABLE = ('.tex', '.sty', '.cls')
+
+
+def _stat_key(path: str) -> Optional[List[int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+class DependencyGraph:
+    def __init__(
+            self, root: str, cache_file: str, auxdir: str,
+            cwd: Optional[str] = None,
+            ) -> None:
+        # cwd is where the engine runs, which relative paths are from.
+        self.root = root
+        self.cache_file = cache_file
+        self._auxdir = os.path.abspath(auxdir)
+        self._cwd = os.path.abspath(cwd or os.curdir)
+        self._search_dirs = [os.path.dirname(os.path.abspath(root)),
+                             self._cwd]
+        self._entries = {}  # type: Dict[str, Dict[str, Any]]
+        self._recorded = set()  # type: Set[str]
+        self._dirty = False
+        # resolve and readRecorder may run from different build threads.
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self) -> None:
+        try:
+            with open(self.cache_file) as fd:
+                cache = json.load(fd)
+        except (OSError, ValueError):
+            return
+        if cache.get('version') != _CACHE_VERSION or \
+                cache.get('root') != os.path.abspath(self.root):
+            return
+        self._entries = cache.get('entries', {})
+        self._recorded = set(cache.get('recorded', []))
+
+    def _save(self) -> None:
+        # Called with _lock held.
+        directory = os.path.dirname(self.cache_file) or '.'
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=directory)
+        try:
+            with open(fd, 'w') as tmp:
+                json.dump({
+                    'version': _CACHE_VERSION,
+                    'root': os.path.abspath(self.root),
+                    'entries': self._entries,
+                    'recorded': sorted(self._recorded),
+                }, tmp)
+            os.replace(tmp_name, self.cache_file)
+        except BaseException:
+            os.remove(tmp_name)
+            raise
+        self._dirty = False
+
+    def _is_local(self, path: str) -> bool:
+        path = os.path.abspath(path)
+        if path.startswith(self._auxdir + os.sep):
+            return False
+        return any(path.startswith(directory + os.sep)
+                   for directory in self._search_dirs)
+
+    def _find(self, name: str, extensions: List[str]) -> Optional[str]:
+        name = name.strip()
+        if not name:
+            return None
+        for directory in self._search_dirs:
+            candidate = os.path.join(directory, name)
+            for ext in [''] + extensions:
+                if os.path.isfile(candidate + ext):
+                    return os.path.relpath(candidate + ext)
+        return None
+
+    def _scan(self, path: str) -> List[str]:
+        found = []  # type: List[str]
+        try:
+            with open(path, errors='replace') as fd:
+                text = ''.join(_COMMENT.sub('', line) for line in fd)
+        except OSError:
+            return found
+        for command, argument in _COMMAND.findall(text):
+            if command in _LISTS:
+                names = argument.split(',')
+            else:
+                names = [argument]
+            for name in names:
+                dependency = self._find(name, _EXTENSIONS[command])
+                if dependency is not None and dependency not in found:
+                    found.append(dependency)
+        return found
+
+    def _direct(self, path: str) -> List[str]:
+        key = _stat_key(path)
+        entry = self._entries.get(path)
+        if entry is not None and entry['stat'] == key:
+            return entry['deps']
+        deps = self._scan(path)
+        self._entries[path] = {'stat': key, 'deps': deps}
+        self._dirty = True
+        return deps
+
+    def resolve(self) -> Set[str]:
+        with self._lock:
+            return self._resolve()
+
+    def _resolve(self) -> Set[str]:
+        seen = set()  # type: Set[str]
+        stack = [self.root]
+        while stack:
+            path = stack.pop()
+            if path in seen:
+                continue
+            seen.add(path)
+            if path.endswith(_SCANNABLE):
+                stack.extend(self._direct(path))
+        # Drop cache entries for files that are no longer included.
+        for stale in set(self._entries) - seen:
+            del self._entries[stale]
+            self._dirty = True
+        if self._dirty:
+            self._save()
+        seen.discard(self.root)
+        return seen | {path for path in self._recorded
+                       if os.path.isfile(path)}
+
+    def readRecorder(self, fls_name: str) -> None:
+        with self._lock:
+            self._readRecorder(fls_name)
+
+    def _readRecorder(self, fls_name: str) -> None:
+        recorded = set()  # type: Set[str]
+        try:
+            with open(fls_name, errors='replace') as fd:
+                lines = fd.readlines()
+        except OSError:
+            return
+        for line in lines:
+            if not line.startswith('INPUT '):
+                continue
+            path = os.path.join(self._cwd, line[len('INPUT '):].rstrip('\n'))
+            if self._is_local(path) and os.path.isfile(path):
+                recorded.add(os.path.relpath(path))
+        recorded.discard(os.path.relpath(self.root))
+        if recorded != self._recorded:
+            self._recorded = recorded
+            self._dirty = True
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import re
+import subprocess
+from typing import List, Dict, Optional, Tuple
+
+_BEGIN_DOCUMENT = re.compile(r'^[^%\n]*?(\\begin\s*\{document\})', re.M)
+
+_engine_versions = {}  # type: Dict[str, str]
+
+
+def engineVersion(engine: str) -> str:
+    if engine not in _engine_versions:
+        try:
+            _engine_versions[engine] = subprocess.run(
+                [engine, '--version'],
+                stdout=subprocess.PIPE,
+                universal_newlines=True,
+            ).stdout.split('\n')[0]
+        except FileNotFoundError:
+            _engine_versions[engine] = ''
+    return _engine_versions[engine]
+
+
+def _stat_key(path: str) -> Optional[List[int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+class PreambleFormat:
+    # Dumps everything before \begin{document} into a format file, so
+    # later runs only have to typeset the body.
+    def __init__(self, file_name: str, auxdir: str, engine: str) -> None:
+        self.file_name = file_name
+        self.auxdir = auxdir
+        self.engine = engine
+        job = os.path.basename(file_name)[:-len('.tex')]
+        self.job = job
+        self.format_job = job + '-preamble'
+        self.format_name = os.path.join(auxdir, self.format_job + '.fmt')
+        self.preamble_name = os.path.join(auxdir, self.format_job + '.tex')
+        self.body_name = os.path.join(auxdir, job + '.body.tex')
+        self.state_name = os.path.join(auxdir, self.format_job + '.json')
+        self._preamble = None  # type: Optional[str]
+        self._body = ''
+        self._key = ''
+
+    def _split(self) -> None:
+        try:
+            with open(self.file_name, errors='replace') as fd:
+                text = fd.read()
+        except OSError:
+            self._preamble = None
+            return
+        match = _BEGIN_DOCUMENT.search(text)
+        if match is None:
+            self._preamble = None
+            return
+        self._preamble = text[:match.start(1)]
+        # Keep the body on the same line numbers as in the real file so
+        # errors still point at the right line.
+        self._body = '\n' * self._preamble.count('\n') + \
+            text[match.start(1):]
+        self._key = hashlib.blake2b(
+            '\0'.join((self._preamble, self.engine,
+                       engineVersion(self.engine))).encode()
+        ).hexdigest()
+
+    def _state(self) -> Dict:
+        try:
+            with open(self.state_name) as fd:
+                return json.load(fd)
+        except (OSError, ValueError):
+            return {}
+
+    def refresh(self) -> Tuple[bool, bool]:
+        # Returns whether a dump is needed, and whether the format can be
+        # used once any dump is done.
+        self._split()
+        if self._preamble is None:
+            return False, False
+        state = self._state()
+        if state.get('key') == self._key and \
+                all(_stat_key(path) == key
+                    for path, key in state.get('inputs', {}).items()):
+            # Don't retry a preamble that wouldn't dump until it changes.
+            if state.get('failed', False):
+                return False, False
+            if os.path.exists(self.format_name):
+                return False, True
+        return True, True
+
+    def dumpCommand(self) -> List[str]:
+        # Only asked for once refresh() has found a preamble.
+        assert self._preamble is not None
+        os.makedirs(self.auxdir, exist_ok=True)
+        with open(self.preamble_name, 'w') as fd:
+            fd.write(self._preamble + '\n\\dump\n')
+        return [self.engine, '-ini', '-recorder',
+                '-interaction=nonstopmode',
+                '-jobname=' + self.format_job,
+                '-output-directory', self.auxdir,
+                '&' + os.path.basename(self.engine),
+                self.preamble_name]
+
+    def recordDump(self, returncode: int) -> None:
+        # Every file read while dumping invalidates the format when it
+        # changes, whether it is a local .sty or one from the distribution.
+        inputs = {}  # type: Dict[str, Optional[List[int]]]
+        try:
+            with open(os.path.join(self.auxdir, self.format_job + '.fls'),
+                      errors='replace') as fd:
+                for line in fd:
+                    if not line.startswith('INPUT '):
+                        continue
+                    path = line[len('INPUT '):].rstrip('\n')
+                    if path.endswith('.fmt') or os.path.basename(path) == \
+                            os.path.basename(self.preamble_name):
+                        continue
+                    inputs[path] = _stat_key(path)
+        except OSError:
+            pass
+        with open(self.state_name, 'w') as fd:
+            json.dump({
+                'key': self._key,
+                'failed': returncode != 0 or
+                not os.path.exists(self.format_name),
+                'inputs': inputs,
+            }, fd)
+
+    def compileCommand(self, options: List[str]) -> List[str]:
+        with open(self.body_name, 'w') as fd:
+            fd.write(self._body)
+        return [self.engine,
+                '-fmt=' + os.path.abspath(self.format_name),
+                '-jobname=' + self.job] + options + [self.body_name]
@@ -0,0 +1,114 @@
+import os
+import re
+from typing import List, Optional
+
+# TeX wraps its terminal output at this many characters.
+_MAX_PRINT_LINE = 79
+
+_OPEN_FILE = re.compile(r'\(([^\s(){}]*)')
+_LINE_NUMBER = re.compile(r'^l\.(\d+)')
+# Messages after which the engine stops, whatever the interaction mode.
+_FATAL = (
+    '! Emergency stop.',
+    '!  ==> Fatal error occurred',
+    '! TeX capacity exceeded',
+    "! I can't find file",
+    "! I can't write on file",
+)
+
+
+class LaTeXError:
+    def __init__(self, file_name: str, message: str) -> None:
+        self.file_name = file_name
+        self.line = None  # type: Optional[int]
+        self.message = message
+
+    def __str__(self) -> str:
+        # The same shape as a compiler's, so editors can jump to it.
+        if self.line is None:
+            return '%s: %s' % (self.file_name, self.message)
+        return '%s:%d: %s' % (self.file_name, self.line, self.message)
+
+
+class LogParser:
+    # Follows the engine's output line by line, keeping track of which
+    # file it is in from the parentheses it prints around each one.
+    def __init__(
+            self, file_name: str, auxdir: str, halt_on_error: bool = False,
+            ) -> None:
+        self.file_name = file_name
+        self.halt_on_error = halt_on_error
+        # The preamble format compiles a copy of the body, padded to the
+        # same line numbers, from the auxdir.
+        self._body_name = os.path.join(
+            os.path.abspath(auxdir),
+            os.path.basename(file_name)[:-len('.tex')] + '.body.tex')
+        self._files = []  # type: List[Optional[str]]
+        self._partial = ''
+        # The first error, which the later ones are usually caused by.
+        self.error = None  # type: Optional[LaTeXError]
+        self._awaiting_line = False
+        self.fatal = False
+
+    def _current_file(self) -> str:
+        for name in reversed(self._files):
+            if name is None:
+                continue
+            if os.path.abspath(name) == self._body_name:
+                return self.file_name
+            return name
+        return self.file_name
+
+    def _track_files(self, line: str) -> None:
+        position = 0
+        while position < len(line):
+            char = line[position]
+            if char == '(':
+                match = _OPEN_FILE.match(line, position)
+                # Always matches, if only the empty name.
+                assert match is not None
+                name = match.group(1)
+                # Keep the parentheses balanced even for ones which aren't
+                # around a file.
+                self._files.append(
+                    name if '.' in name or '/' in name else None)
+                position = match.end()
+                continue
+            if char == ')' and self._files:
+                self._files.pop()
+            position += 1
+
+    def feed(self, line: str) -> bool:
+        # Returns True once the build is known to have failed, so the
+        # engine can be stopped. After a fatal error that is only once its
+        # line number is in, if one is still to come; otherwise the engine
+        # is left to exit by itself.
+        line = self._partial + line.rstrip('\n')
+        if len(line) % _MAX_PRINT_LINE == 0 and line and \
+                not line.startswith('!'):
+            # Wrapped: the rest of it is on the next line.
+            self._partial = line
+            return False
+        self._partial = ''
+
+        if line.startswith('!'):
+            if line.startswith(_FATAL):
+                self.fatal = True
+            if self.error is None:
+                self.error = LaTeXError(
+                    self._current_file(), line[1:].strip())
+                self._awaiting_line = True
+            return self.fatal and not self._awaiting_line
+
+        match = _LINE_NUMBER.match(line)
+        if match is not None and self.error is not None and \
+                self._awaiting_line:
+            self.error.line = int(match.group(1))
+            self._awaiting_line = False
+            if self.fatal or self.halt_on_error:
+                self.fatal = True
+                return True
+            return False
+
+        self._track_files(line)
+        return False
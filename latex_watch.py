@@ -1,15 +1,20 @@
 #!/usr/bin/python3
 
+import hashlib
 import os
+import re
 import sys
 import subprocess
-import time
 import shared_watch
-from shared_watch import Build
-from typing import List, Tuple, Dict, Any, Callable, NewType
+import latex_deps
+import latex_format
+import latex_log
+import sage_worker
+from shared_watch import Build, SwapFilesWatch
+from typing import List, Tuple, Dict, Any, Callable, Optional
 
 ProcessedArgs = Dict[str, Any]
-Recipe = NewType("Recipe", Dict[str, Any])
+Recipe = shared_watch.Recipe
 MainForFileMethod = Callable[[ProcessedArgs], None]
 FilePair = Tuple[MainForFileMethod, ProcessedArgs]
 
@@ -19,8 +24,17 @@ def usage(exit_code: int, name: object) -> None:
                   " [--sagetex|-s]" +
                   " [--biber|-b]" +
                   " [--auxdir </tmp/$USER-LaTeX>|-a </tmp/$USER-LaTeX>]" +
-                  " [--engine <pdflatex>|-e <pdflatex>]" + " <file.tex>" +
-                  " [--slow|-S]") % str(name)
+                  " [--engine <pdflatex>|-e <pdflatex>]" +
+                  " [--max-passes <5>]" +
+                  " [--fmt]" +
+                  " [--sage <sage>]" +
+                  " [--warm-sage]" +
+                  " [--halt-on-error]" + " <file.tex>" +
+                  " [--slow|-S]" +
+                  " [--poll|-P]" +
+                  " [--jobs <ncpu>|-j <ncpu>]" +
+                  " [--semantic]" +
+                  " [--state-dir <~/.cache/file_watch>]") % str(name)
 
     if exit_code == 0:
         print(usage_text)
@@ -31,10 +45,44 @@ def usage(exit_code: int, name: object) -> None:
     exit(exit_code)
 
 
+# Outputs which feed back into the next engine pass. If any of these changed
+# during a pass the document hasn't converged yet.
+_RERUN_EXTENSIONS = ('aux', 'toc', 'lof', 'lot', 'out', 'nav', 'snm')
+# How each engine is told to skip writing its output on passes which are
+# known to be followed by another.
+_DRAFT_OPTIONS = {
+    'pdflatex': '-draftmode',
+    'lualatex': '-draftmode',
+    'xelatex': '-no-pdf',
+}
+# Lines sagetex writes into its script recording where each block is in the
+# document, which is all that changes when text is edited around them.
+# sagetex's own run-if-necessary check leaves them out too.
+_SAGE_LINE_NUMBER = re.compile(rb'^ ?_st_\.current_tex_line\b')
+
+
+def _sage_script_digest(file_name: str) -> bytes:
+    digest = hashlib.blake2b()
+    with open(file_name, 'rb') as fd:
+        for line in fd:
+            if not _SAGE_LINE_NUMBER.match(line):
+                digest.update(line)
+    return digest.digest()
+
+
 class LaTeXBuild(Build):
     def __init__(self, recipe: Recipe) -> None:
-        self.recipe = recipe
-        self.addToBuild('latex')
+        super().__init__(recipe)
+        # Digests of auxiliary files as of the last time we looked at them.
+        self._aux_digests = {}  # type: Dict[str, Optional[bytes]]
+        # The FileWatch.version of each bibliography as of the last biber
+        # run, since editing one doesn't change the .bcf.
+        self._biber_versions = {}  # type: Dict[shared_watch.FileWatch, int]
+        # Whether the next engine pass may skip writing the PDF.
+        self.draft = False
+        # Digest of what is in ~/.latex, so unchanged PDFs aren't copied.
+        self._backup_digest = None  # type: Optional[bytes]
+        self.addToBuild('passes')
         self.addWatchedFile(recipe['file'])
 
         self.pdfname = os.path.join(
@@ -46,58 +94,253 @@ class LaTeXBuild(Build):
             )
         )
 
-        if recipe['biber']:
-            self.addToBuild('biber')
-
-        if recipe['sagetex']:
-            self.addToBuild('sagetex')
-
         if recipe['extra_files']:
             for i in recipe['extra_files']:
                 self.addWatchedFile(i)
 
-        if recipe['biber'] or recipe['sagetex']:
-            self.addToBuild('latex')
+        self.flsname = self.auxFile('fls')
+        self.dependencies = latex_deps.DependencyGraph(
+            recipe['file'],
+            self.auxFile('deps.json'),
+            recipe['auxdir'],
+            recipe['cwd'],
+        )
+        self.watchDependencies()
+        # What's already in the auxdir, as kept from an earlier run or
+        # restored from a snapshot, doesn't count as changed.
+        for extension in _RERUN_EXTENSIONS + \
+                ('bcf', 'bbl', 'sagetex.sage', 'sagetex.sout'):
+            self._aux_digests[extension] = self._aux_fingerprint(extension)
+
+        self.sageWorker = None  # type: Optional[sage_worker.SageWorker]
+        if recipe['sagetex'] and recipe['warm_sage']:
+            self.sageWorker = sage_worker.SageWorker(recipe['sage'])
+
+        self.preamble = None  # type: Optional[latex_format.PreambleFormat]
+        if recipe['fmt']:
+            self.preamble = latex_format.PreambleFormat(
+                recipe['file'], recipe['auxdir'], recipe['engine'])
 
         self.addToBuild('backup')
         if recipe['make']:
             self.build_steps = [self.make]
 
+    def outputs(self) -> List[str]:
+        return [self.pdfname]
+
+    def close(self) -> None:
+        super().close()
+        if self.sageWorker is not None:
+            self.sageWorker.close()
+
+    def auxFile(self, extension: str) -> str:
+        # Same reversing trick as pdfname, for any of the engine's outputs.
+        return os.path.join(
+            self.recipe['auxdir'],
+            os.path.basename(self.recipe['file'][:: -1].replace(
+                'xet', extension[:: -1], 1)[:: -1])
+        )
+
+    def _aux_fingerprint(self, extension: str) -> Optional[bytes]:
+        try:
+            if extension == 'sagetex.sage':
+                return _sage_script_digest(self.auxFile(extension))
+            return shared_watch.digestFile(self.auxFile(extension))
+        except FileNotFoundError:
+            return None
+
+    def _aux_changed(self, extension: str) -> bool:
+        # Reports whether the file differs from when this was last asked.
+        digest = self._aux_fingerprint(extension)
+        changed = digest is not None and \
+            digest != self._aux_digests.get(extension)
+        self._aux_digests[extension] = digest
+        return changed
+
+    def _missing(self, extension: str) -> bool:
+        return not os.path.exists(self.auxFile(extension))
+
+    def passes(self):
+        # A pass is only run as a draft when another is certain to follow:
+        # while the bibliography or Sage output doesn't exist yet, and for
+        # the pass straight after either is first created.
+        draft = (self.recipe['biber'] and self._missing('bbl')) or \
+            (self.recipe['sagetex'] and self._missing('sagetex.sout'))
+        for passes in range(1, self.recipe['max_passes'] + 1):
+            rerun = False
+            self.draft = draft and passes < self.recipe['max_passes']
+            self.runStep(self.latex)
+            for extension in _RERUN_EXTENSIONS:
+                rerun = self._aux_changed(extension) or rerun
+
+            # biber and Sage read and write different files, so they run
+            # side by side and are both done before the next pass.
+            draft = False
+            steps = {}  # type: Dict[str, shared_watch.Step]
+            if self.recipe['biber'] and \
+                    (self._aux_changed('bcf') or self._missing('bbl') or
+                     self._bibliography_changed()):
+                draft = self._missing('bbl')
+                steps['bbl'] = shared_watch.Step(
+                    self.biber,
+                    inputs=[self.auxFile('bcf')],
+                    outputs=[self.auxFile('bbl'), self.auxFile('blg')])
+            if self.recipe['sagetex'] and \
+                    (self._aux_changed('sagetex.sage') or
+                     self._missing('sagetex.sout')):
+                draft = draft or self._missing('sagetex.sout')
+                steps['sagetex.sout'] = shared_watch.Step(
+                    self.sagetex,
+                    inputs=[self.auxFile('sagetex.sage')],
+                    outputs=[self.auxFile('sagetex.sout'),
+                             self.auxFile('sagetex.digest')])
+            self.runSteps(list(steps.values()))
+            for extension in steps:
+                rerun = self._aux_changed(extension) or rerun
+
+            if not rerun:
+                if self.draft:
+                    # Converged sooner than expected, but there's no output
+                    # yet.
+                    self.draft = False
+                    self.runStep(self.latex)
+                return
+        print("LaTeX did not converge after", passes, "passes.",
+              file=sys.stderr)
+
+    def watchDependencies(self):
+        for dependency in sorted(self.dependencies.resolve()):
+            self.addWatchedFile(dependency)
+
+    def hasAnythingChanged(self):
+        changed = super().hasAnythingChanged()
+        if changed:
+            # An edited source may have gained new \input{}s and the like.
+            self.watchDependencies()
+        return changed
+
+    def fmt(self):
+        returncode = self.call(self.preamble.dumpCommand())
+        self.preamble.recordDump(returncode)
+
     def latex(self):
-        subprocess.call([self.recipe['engine'],
-                         '-output-directory',
-                         self.recipe['auxdir'],
-                         "-interaction=nonstopmode", self.recipe['file']])
+        options = ['-output-directory',
+                   self.recipe['auxdir'],
+                   '-recorder',
+                   "-interaction=nonstopmode"]
+        engine = os.path.basename(self.recipe['engine'])
+        if self.draft and engine in _DRAFT_OPTIONS:
+            options.append(_DRAFT_OPTIONS[engine])
+        if self.recipe['halt_on_error']:
+            options.append('-halt-on-error')
+        log = latex_log.LogParser(self.recipe['file'], self.recipe['auxdir'],
+                                  self.recipe['halt_on_error'])
+        usable = False
+        if self.preamble is not None:
+            needsDump, usable = self.preamble.refresh()
+            if needsDump:
+                self.runStep(self.fmt)
+                needsDump, usable = self.preamble.refresh()
+        if usable:
+            self.call(self.preamble.compileCommand(options),
+                      output=log.feed)
+        else:
+            self.call([self.recipe['engine']] + options +
+                      [self.recipe['file']], output=log.feed)
+        self.dependencies.readRecorder(self.flsname)
+        self.watchDependencies()
+        if log.fatal:
+            # Nothing after this can fix the document, so don't run it.
+            raise shared_watch.BuildFailed(log.error)
 
     def make(self):
-        subprocess.call(['make'])
+        self.call(['make'])
+
+    def _bibliographies(self) -> List[shared_watch.FileWatch]:
+        # As found through \bibliography and \addbibresource.
+        return [watch for watch in self.watchedFiles
+                if watch.file_name.endswith('.bib')]
+
+    def _bibliography_changed(self) -> bool:
+        return any(watch.version != self._biber_versions.get(watch)
+                   for watch in self._bibliographies())
 
     def biber(self):
-        subprocess.call(
+        # Taken before biber reads them, so an edit made while it runs
+        # still counts as a change next time.
+        versions = {watch: watch.version for watch in self._bibliographies()}
+        returncode = self.call(
             ["biber",
              "--output-directory", self.recipe['auxdir'],
                 "--input-directory", self.recipe['auxdir'],
                 os.path.basename(self.recipe
                                  ['file'][:: -1].replace
                                  ('xet.', '', 1)[:: -1])])
+        if returncode == 0:
+            self._biber_versions = versions
 
     def sagetex(self):
-        firstdir = os.getcwd()
-        os.chdir(self.recipe['auxdir'])
-        subprocess.call(
-            ['sage',
-                os.path.basename(self.recipe
-                                 ['file'][:: -1].replace
-                                 ('xet', 'egas.xetegas', 1)[:: -1])])
-        os.chdir(firstdir)
+        script = os.path.basename(self.auxFile('sagetex.sage'))
+        try:
+            digest = _sage_script_digest(self.auxFile('sagetex.sage'))
+        except FileNotFoundError:
+            return
+        # The .sout from the last successful run still matches the script,
+        # so there is nothing for Sage to do.
+        if os.path.exists(self.auxFile('sagetex.sout')) and \
+                self._sage_digest() == digest:
+            return
+
+        returncode = None
+        if self.sageWorker is not None:
+            returncode = self.sageWorker.run(self.recipe['auxdir'], script)
+            self.checkCancelled()
+            if returncode is not None:
+                self.recordStatus(returncode)
+        if returncode is None:
+            # Run in the auxdir through cwd rather than os.chdir(), which
+            # would move every other watch thread too.
+            returncode = self.call([self.recipe['sage'], script],
+                                   cwd=self.recipe['auxdir'])
+        if returncode == 0:
+            with open(self.auxFile('sagetex.digest'), 'w') as fd:
+                fd.write(digest.hex())
+
+    def _sage_digest(self) -> Optional[bytes]:
+        try:
+            with open(self.auxFile('sagetex.digest')) as fd:
+                return bytes.fromhex(fd.read().strip())
+        except (OSError, ValueError):
+            return None
+
+    def cancel(self):
+        super().cancel()
+        if self.sageWorker is not None:
+            self.sageWorker.kill()
 
     def backup(self):
-        subprocess.call(['cp', self.pdfname, os.path.expanduser('~/.latex/')])
+        backupName = os.path.join(
+            os.path.expanduser('~/.latex'), os.path.basename(self.pdfname))
+        try:
+            digest = shared_watch.digestFile(self.pdfname)
+        except FileNotFoundError:
+            return
+        if self._backup_digest is None:
+            try:
+                self._backup_digest = shared_watch.digestFile(backupName)
+            except FileNotFoundError:
+                pass
+        if digest == self._backup_digest:
+            return
+        os.makedirs(os.path.dirname(backupName), exist_ok=True)
+        shared_watch.copyFileAtomically(self.pdfname, backupName)
+        self._backup_digest = digest
 
     def addToBuild(self, nameOfCompilationStep):
         self.build_steps.append(
             {
                 'latex': self.latex,
+                'passes': self.passes,
                 'biber': self.biber,
                 'sagetex': self.sagetex,
                 'backup': self.backup,
@@ -107,17 +350,25 @@ class LaTeXBuild(Build):
         )
 
 
-def processargs(input_argv: List[str]) -> ProcessedArgs:
+def processargs(
+        input_argv: List[str], cwd: Optional[str] = None,
+        ) -> ProcessedArgs:
     processingArgs = shared_watch.ProcessArgs(
             input_argv,
             usage,
             LaTeXBuild,
-            "LaTeX"
+            "LaTeX",
+            cwd,
             )
 
     processingArgs.output_recipe['sagetex'] = False
     processingArgs.output_recipe['biber'] = False
     processingArgs.output_recipe['engine'] = "pdflatex"
+    processingArgs.output_recipe['max_passes'] = 5
+    processingArgs.output_recipe['fmt'] = False
+    processingArgs.output_recipe['sage'] = "sage"
+    processingArgs.output_recipe['warm_sage'] = False
+    processingArgs.output_recipe['halt_on_error'] = False
 
     def _sagetex(i: int):
         processingArgs.output_recipe['sagetex'] = True
@@ -140,6 +391,41 @@ def processargs(input_argv: List[str]) -> ProcessedArgs:
     processingArgs.long_args_to_disc['--engine'] = _engine
     processingArgs.short_args_to_disc['e'] = _engine
 
+    def _max_passes(i: int):
+        if '=' in input_argv[i]:
+            max_passes = input_argv[i].split('=')[1]
+        else:
+            max_passes = input_argv[i + 1]
+            processingArgs.indexes_to_ignore.append(i + 1)
+
+        if int(max_passes) < 1:
+            print("--max-passes must be at least 1", file=sys.stderr)
+            processingArgs.usage_func(1, processingArgs.output['name'])
+        processingArgs.output_recipe["max_passes"] = int(max_passes)
+    processingArgs.long_args_to_disc['--max-passes'] = _max_passes
+
+    def _fmt(i: int):
+        processingArgs.output_recipe['fmt'] = True
+    processingArgs.long_args_to_disc['--fmt'] = _fmt
+
+    def _sage(i: int):
+        if '=' in input_argv[i]:
+            sage = input_argv[i].split('=')[1]
+        else:
+            sage = input_argv[i + 1]
+            processingArgs.indexes_to_ignore.append(i + 1)
+
+        processingArgs.output_recipe["sage"] = sage
+    processingArgs.long_args_to_disc['--sage'] = _sage
+
+    def _warm_sage(i: int):
+        processingArgs.output_recipe['warm_sage'] = True
+    processingArgs.long_args_to_disc['--warm-sage'] = _warm_sage
+
+    def _halt_on_error(i: int):
+        processingArgs.output_recipe['halt_on_error'] = True
+    processingArgs.long_args_to_disc['--halt-on-error'] = _halt_on_error
+
     return processingArgs.render_processargs()
 
 
@@ -161,30 +447,7 @@ class ShouldExit():
             return False
 
 
-class SwapFilesWatch():
-    _num_of_returns = 0
-    swapsToCheck = []  # type: List[str]
-
-    def __init__(self, primaryFile, extraFiles) -> None:
-        self.swapsToCheck.append(os.path.join(os.path.dirname(primaryFile),
-                                 '.' + os.path.basename(primaryFile) + '.swp'))
-        for singleFile in extraFiles:
-            self.swapsToCheck.append(os.path.join(
-                os.path.dirname(singleFile),
-                '.' + os.path.basename(singleFile) +
-                '.swp'))
-
-    def swapFilesExist(self):
-        result = False
-        for swap in self.swapsToCheck:
-            if os.path.exists(swap):
-                result = True
-                break
-
-        return result
-
-
-def main_for_file(args: ProcessedArgs) -> None:
+def prepare_for_file(args: ProcessedArgs) -> shared_watch.Watch:
     os.makedirs(os.path.expandvars(args['auxdir']), exist_ok=True)
     if args['slow']:
         pdfname = os.path.join(
@@ -202,27 +465,34 @@ def main_for_file(args: ProcessedArgs) -> None:
             os.path.basename(args['file'][:: -1].replace
                              ('xet', 'fdp', 1)[:: -1]))
     swapWatch = SwapFilesWatch(args['file'], args['extra_files'])
-    args['build'].build()
-    if not args['disable_viewer']:
-        try:
-            subprocess.call(['rifle', pdfname])
-        except FileNotFoundError:
-            print("rifle not installed.", file=sys.stderr)
+
+    def open_viewer() -> None:
+        if not args['disable_viewer']:
+            try:
+                subprocess.call(['rifle', pdfname])
+            except FileNotFoundError:
+                print("rifle not installed.", file=sys.stderr)
     if os.getenv('VIM', False):
-        return
+        return shared_watch.Watch(args['build'], None, open_viewer)
 
-    while swapWatch.swapFilesExist():
-        try:
-            if args['build'].hasAnythingChanged():
-                args['build'].build()
-            time.sleep(5)
-        except KeyboardInterrupt:
-            args['build'].build()
-
-    if args['build'].hasAnythingChanged():
-        args['build'].build()
-        if swapWatch.swapFilesExist():
-            main_for_file(args)
+    # Wake up when the swap files go away too, not only on edits.
+    for swap in swapWatch.swapsToCheck:
+        args['build'].watchPath(swap)
+
+    return shared_watch.Watch(
+        args['build'], swapWatch.swapFilesExist, open_viewer,
+        swapWatch.pathsChanged)
+
+
+def main_for_file(args: ProcessedArgs) -> None:
+    if os.getenv('VIM', False) and \
+            shared_watch.sendTrigger(args['auxdir'], args['file']):
+        # Run from the editor while a watch is already running, which
+        # starts the build straight away.
+        return
+    loop = shared_watch.WatchLoop(args['jobs'])
+    loop.add(prepare_for_file(args))
+    loop.run()
 
 
 if __name__ == '__main__':
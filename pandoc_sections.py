@@ -0,0 +1,143 @@
+import re
+from typing import List, Optional, Set
+
+# Writers whose output for a document is just the output for each of its
+# top-level sections one after another.
+EXTENSIONS = ('.html', '.htm', '.xhtml')
+
+# Options which make the output depend on the document as a whole.
+_WHOLE_DOCUMENT_OPTIONS = {
+    '-s', '--standalone',
+    '--toc', '--table-of-contents',
+    '-N', '--number-sections', '--number-offset',
+    '-C', '--citeproc', '--bibliography', '--csl',
+    '-F', '--filter', '-L', '--lua-filter',
+    '--self-contained', '--embed-resources',
+    '-M', '--metadata', '--metadata-file',
+    '-H', '--include-in-header',
+    '-B', '--include-before-body',
+    '-A', '--include-after-body',
+}
+
+_FENCE = re.compile(r'^ {0,3}(`{3,}|~{3,})')
+_ATX_HEADING = re.compile(r'^ {0,3}(#{1,6})(?:[ \t]+(.*?))?[ \t#]*$')
+_SETEXT_UNDERLINE = re.compile(r'^ {0,3}(=+|-+)[ \t]*$')
+_REFERENCE = re.compile(r'^ {0,3}\[([^\]^][^\]]*)\]:')
+_HEADING_ATTRIBUTES = re.compile(r'\s*\{[^}]*\}\s*$')
+_DIV_OPEN = re.compile(r'^ {0,3}:{3,}\s*\S|<div\b', re.M | re.I)
+_DIV_CLOSE = re.compile(r'^ {0,3}:{3,}\s*$|</div\s*>', re.M | re.I)
+# Numbered across the whole document, or defined once for all of it.
+_WHOLE_DOCUMENT_SYNTAX = re.compile(
+    r'\[\^|\^\[|\(@|\\(?:re)?newcommand|\\def\b')
+
+
+def _identifier(heading: str) -> str:
+    # Near enough to pandoc's own to catch headings which would collide.
+    heading = _HEADING_ATTRIBUTES.sub('', heading).lower()
+    return re.sub(r'[^\w.-]+', '-', heading).strip('-')
+
+
+def split(text: str, options: List[str]) -> Optional[List[str]]:
+    # Returns the document's top-level sections, each with every reference
+    # definition appended so links across sections still resolve. Returns
+    # None if converting them one by one could come out any different.
+    for option in options:
+        if option.split('=')[0] in _WHOLE_DOCUMENT_OPTIONS:
+            return None
+    if _WHOLE_DOCUMENT_SYNTAX.search(text):
+        return None
+
+    lines = text.splitlines(True)
+    sections = [[]]  # type: List[List[str]]
+    headings = []  # type: List[Set[str]]
+    sectionHeadings = set()  # type: Set[str]
+    references = []  # type: List[str]
+    labels = set()  # type: Set[str]
+    identifiers = set()  # type: Set[str]
+    fence = ''
+    previous = ''
+    for i, line in enumerate(lines):
+        match = _FENCE.match(line)
+        if fence:
+            if match is not None and \
+                    match.group(1)[0] == fence[0] and \
+                    len(match.group(1)) >= len(fence):
+                fence = ''
+            sections[-1].append(line)
+            previous = line
+            continue
+        if match is not None:
+            fence = match.group(1)
+            sections[-1].append(line)
+            previous = line
+            continue
+
+        heading = None  # type: Optional[str]
+        level = 0
+        match = _ATX_HEADING.match(line) if not previous.strip() else None
+        if match is not None:
+            heading = match.group(2) or ''
+            level = len(match.group(1))
+        elif previous.strip() and _SETEXT_UNDERLINE.match(line):
+            heading = previous.strip()
+            level = 1 if line.strip()[0] == '=' else 2
+        elif line.rstrip() == '---' and i + 1 < len(lines) and \
+                lines[i + 1].strip():
+            # A metadata block, which applies to the whole document.
+            return None
+
+        if heading is not None:
+            identifier = _identifier(heading)
+            if identifier in identifiers:
+                # pandoc numbers repeated identifiers document wide.
+                return None
+            identifiers.add(identifier)
+            if level == 1:
+                if match is None:
+                    # A setext heading starts on the line before.
+                    sections[-1].pop()
+                    sections.append([previous])
+                else:
+                    sections.append([])
+                headings.append(sectionHeadings)
+                sectionHeadings = set()
+            sectionHeadings.add(
+                _HEADING_ATTRIBUTES.sub('', heading).strip().lower())
+
+        match = _REFERENCE.match(line)
+        if match is not None:
+            label = match.group(1).strip().lower()
+            if label in labels:
+                return None
+            labels.add(label)
+            references.append(line if line.endswith('\n') else line + '\n')
+        sections[-1].append(line)
+        previous = line
+    headings.append(sectionHeadings)
+
+    texts = [''.join(section) for section in sections]
+    for section in texts:
+        if len(_DIV_OPEN.findall(section)) != \
+                len(_DIV_CLOSE.findall(section)):
+            # A div left open across a heading.
+            return None
+    # A heading's text in brackets links to it from anywhere, which only
+    # works within the one section.
+    for i, section in enumerate(texts):
+        lowered = section.lower()
+        for j, others in enumerate(headings):
+            if j != i and any('[' + heading + ']' in lowered
+                              for heading in others):
+                return None
+
+    output = []  # type: List[str]
+    for section, sectionLines in zip(texts, sections):
+        if not section.strip():
+            continue
+        missing = [reference for reference in references
+                   if reference not in sectionLines and
+                   reference.rstrip('\n') not in sectionLines]
+        if missing:
+            section += '\n' + ''.join(missing)
+        output.append(section)
+    return output
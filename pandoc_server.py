@@ -0,0 +1,175 @@
+import atexit
+import base64
+import json
+import os
+import socket
+import subprocess
+import threading
+import time
+import urllib.request
+from typing import List, Dict, Any, Optional
+
+# Writers pandoc-server can produce, by output file extension. PDF needs an
+# external engine, which the server won't run, so it isn't here.
+_WRITERS = {
+    '.html': 'html5',
+    '.htm': 'html5',
+    '.tex': 'latex',
+    '.md': 'markdown',
+    '.rst': 'rst',
+    '.txt': 'plain',
+    '.docx': 'docx',
+    '.odt': 'odt',
+    '.epub': 'epub3',
+}
+# Command line flags with a direct equivalent in a server request.
+_FLAGS = {
+    '-s': 'standalone',
+    '--standalone': 'standalone',
+    '--toc': 'table-of-contents',
+    '--table-of-contents': 'table-of-contents',
+}
+_VALUES = {
+    '-f': 'from',
+    '-r': 'from',
+    '--from': 'from',
+    '--read': 'from',
+    '-t': 'to',
+    '-w': 'to',
+    '--to': 'to',
+    '--write': 'to',
+}
+
+_STARTUP_TIMEOUT = 10
+_REQUEST_TIMEOUT = 60
+
+
+def makeRequest(
+        options: List[str],
+        output_name: str,
+        input_name: str,
+        ) -> Optional[Dict[str, Any]]:
+    # Returns None when the options can't be expressed as a server request,
+    # in which case the caller should run pandoc itself.
+    writer = _WRITERS.get(os.path.splitext(output_name)[1])
+    if writer is None:
+        return None
+    request = {
+        'from': 'markdown',
+        'to': writer,
+    }  # type: Dict[str, Any]
+    i = 0
+    while i < len(options):
+        option = options[i]
+        name, _, value = option.partition('=')
+        if option in _FLAGS:
+            request[_FLAGS[option]] = True
+        elif name in _VALUES and value:
+            request[_VALUES[name]] = value
+        elif option in _VALUES and i + 1 < len(options):
+            request[_VALUES[option]] = options[i + 1]
+            i += 1
+        else:
+            return None
+        i += 1
+    try:
+        with open(input_name, encoding='utf-8') as fd:
+            request['text'] = fd.read()
+    except UnicodeDecodeError:
+        return None
+    return request
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class PandocServer:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._process = None  # type: Optional[subprocess.Popen]
+        self._url = ''
+        # Set once starting has failed, so every build doesn't retry it.
+        self._unavailable = False
+
+    def _running(self) -> bool:
+        return self._process is not None and self._process.poll() is None
+
+    def _start(self) -> bool:
+        port = _free_port()
+        for command in (['pandoc-server'], ['pandoc', 'server']):
+            try:
+                process = subprocess.Popen(
+                    command + ['--port', str(port)],
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    start_new_session=True,
+                )
+            except FileNotFoundError:
+                continue
+            url = 'http://127.0.0.1:%d' % port
+            deadline = time.monotonic() + _STARTUP_TIMEOUT
+            while process.poll() is None and time.monotonic() < deadline:
+                try:
+                    urllib.request.urlopen(url + '/version', timeout=1).close()
+                except OSError:
+                    time.sleep(.05)
+                    continue
+                self._process = process
+                self._url = url
+                return True
+            process.kill()
+            process.wait()
+        self._unavailable = True
+        return False
+
+    def convert(self, request: Dict[str, Any]) -> Optional[bytes]:
+        with self._lock:
+            if self._unavailable:
+                return None
+            if not self._running() and not self._start():
+                return None
+            url = self._url
+        http_request = urllib.request.Request(
+            url,
+            data=json.dumps(request).encode(),
+            headers={
+                'Content-Type': 'application/json',
+                'Accept': 'application/json',
+            },
+        )
+        try:
+            with urllib.request.urlopen(
+                    http_request, timeout=_REQUEST_TIMEOUT) as response:
+                result = json.load(response)
+        except (OSError, ValueError):
+            # Conversion errors come back as HTTP errors too; let the
+            # subprocess path report them properly.
+            return None
+        if result.get('base64'):
+            return base64.b64decode(result['output'])
+        return result['output'].encode('utf-8')
+
+    def close(self) -> None:
+        with self._lock:
+            process = self._process
+            if process is not None and self._running():
+                process.terminate()
+                process.wait()
+            self._process = None
+
+
+_server = None  # type: Optional[PandocServer]
+_server_lock = threading.Lock()
+
+
+def getServer() -> PandocServer:
+    global _server
+    with _server_lock:
+        if _server is None:
+            _server = PandocServer()
+            # The server has its own session, so it won't die with us.
+            atexit.register(_server.close)
+        return _server
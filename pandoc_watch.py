@@ -1,15 +1,18 @@
 #!/usr/bin/python3
 
+import functools
+import hashlib
 import os
 import sys
 import subprocess
-import time
 import shared_watch
-from shared_watch import Build
-from typing import List, Tuple, Dict, Any, Callable, NewType
+import pandoc_sections
+import pandoc_server
+from shared_watch import Build, SwapFilesWatch
+from typing import List, Tuple, Dict, Any, Callable, Optional
 
 ProcessedArgs = Dict[str, Any]
-Recipe = NewType("Recipe", Dict[str, Any])
+Recipe = shared_watch.Recipe
 MainForFileMethod = Callable[[ProcessedArgs], None]
 FilePair = Tuple[MainForFileMethod, ProcessedArgs]
 
@@ -17,8 +20,16 @@ FilePair = Tuple[MainForFileMethod, ProcessedArgs]
 def usage(exit_code: int, name: object):
     usage_text = ("Usage: %s [--help|-h]" +
                   " [--auxdir </tmp/$USER-Pandoc>|-a </tmp/$USER-Pandoc>]" +
+                  " [--output-type <pdf>|-t <pdf>]" +
                   " <file.tex>" +
-                  " [--slow|-S]") % str(name)
+                  " [--slow|-S]" +
+                  " [--poll|-P]" +
+                  " [--jobs <ncpu>|-j <ncpu>]" +
+                  " [--semantic]" +
+                  " [--state-dir <~/.cache/file_watch>]" +
+                  " [--cache-size <256 MiB>]" +
+                  " [--server]" +
+                  " [--incremental]") % str(name)
 
     if exit_code == 0:
         print(usage_text)
@@ -29,12 +40,29 @@ def usage(exit_code: int, name: object):
     exit(exit_code)
 
 
+_pandoc_version = None  # type: Optional[str]
+
+
+def pandoc_version() -> str:
+    global _pandoc_version
+    if _pandoc_version is None:
+        try:
+            _pandoc_version = subprocess.run(
+                ['pandoc', '--version'],
+                stdout=subprocess.PIPE,
+                universal_newlines=True,
+            ).stdout.split('\n')[0]
+        except FileNotFoundError:
+            _pandoc_version = ''
+    return _pandoc_version
+
+
 class PandocBuild(Build):
     def __init__(self, recipe: Recipe) -> None:
+        super().__init__(recipe)
         self.build_map = {
             'pandoc': self.pandoc
         }
-        self.recipe = recipe  # type: Recipe
         self.addToBuild('pandoc')
         if recipe["docx"]:
             _output_file_extension = 'docx'[::-1]
@@ -61,29 +89,205 @@ class PandocBuild(Build):
 
         self.addWatchedFile(recipe['file'])
 
+        if recipe['cache_size']:
+            self.cache = shared_watch.OutputCache(
+                os.path.join(recipe['auxdir'], 'pandoc-cache'),
+                recipe['cache_size'] * 1024 * 1024
+            )  # type: Optional[shared_watch.OutputCache]
+        else:
+            self.cache = None
+
+        # Converted output of each section, for --incremental, by a hash of
+        # the section and how it is converted.
+        self._section_outputs = {}  # type: Dict[str, bytes]
+        # Whether stitching the sections back together has been seen to
+        # give the same output as converting the whole document.
+        self._sections_verified = None  # type: Optional[bool]
+
+    def outputs(self) -> List[str]:
+        return [self.outputName]
+
+    def _cache_key(
+            self, cache: shared_watch.OutputCache, fresh: bool = False,
+            ) -> Optional[str]:
+        # None while any input is missing, as in the middle of a save. With
+        # fresh, the inputs are hashed again rather than trusting the last
+        # digest their watches took.
+        inputs = []  # type: List[str]
+        for watch in sorted(self.watchedFiles,
+                            key=lambda watch: watch.file_name):
+            if watch.pending:
+                return None
+            digest = None if fresh else watch.digest
+            if digest is None:
+                try:
+                    digest = shared_watch.digestFile(watch.file_name)
+                except FileNotFoundError:
+                    return None
+            inputs.append(watch.file_name + '=' + digest.hex())
+        return cache.key(
+            pandoc_version(),
+            os.path.splitext(self.outputName)[1],
+            '\0'.join(self.recipe['pandoc_options']),
+            *inputs)
+
+    def _server_convert(self) -> bool:
+        request = pandoc_server.makeRequest(
+            self.recipe['pandoc_options'],
+            self.outputName,
+            self.recipe['file'],
+        )
+        if request is None:
+            return False
+        output = pandoc_server.getServer().convert(request)
+        if output is None:
+            return False
+        self._write_output(output)
+        return True
+
+    def _write_output(self, output: bytes) -> None:
+        tmp_name = self.outputName + '.tmp'
+        with open(tmp_name, 'wb') as fd:
+            fd.write(output)
+        os.replace(tmp_name, self.outputName)
+
+    def _sections(self) -> Optional[List[str]]:
+        if not self.recipe['incremental'] or \
+                self._sections_verified is False or \
+                os.path.splitext(self.outputName)[1] not in \
+                pandoc_sections.EXTENSIONS:
+            return None
+        try:
+            with open(self.recipe['file'], encoding='utf-8') as fd:
+                text = fd.read()
+        except (OSError, UnicodeDecodeError):
+            return None
+        return pandoc_sections.split(text, self.recipe['pandoc_options'])
+
+    def _convert_section(self, key: str, section: str) -> None:
+        options = self.recipe['pandoc_options']
+        directory = self.outputName + '.sections'
+        input_name = os.path.join(directory, key + '.md')
+        output_name = os.path.join(
+            directory, key + os.path.splitext(self.outputName)[1])
+        with open(input_name, 'w', encoding='utf-8') as fd:
+            fd.write(section)
+        try:
+            output = None
+            if self.recipe['server']:
+                request = pandoc_server.makeRequest(
+                    options, output_name, input_name)
+                if request is not None:
+                    output = pandoc_server.getServer().convert(request)
+            if output is None:
+                if self.call(['pandoc'] + options +
+                             ['-o', output_name, input_name]) != 0:
+                    return
+                with open(output_name, 'rb') as fd:
+                    output = fd.read()
+            self._section_outputs[key] = output
+        finally:
+            for name in (input_name, output_name):
+                if os.path.exists(name):
+                    os.remove(name)
+
+    def _convert_sections(self, sections: List[str]) -> Optional[bytes]:
+        # Converts only the sections not converted before, as many at once
+        # as there are cores, and joins them. Returns None if any failed.
+        os.makedirs(self.outputName + '.sections', exist_ok=True)
+        prefix = '\0'.join([pandoc_version(),
+                            os.path.splitext(self.outputName)[1]] +
+                           self.recipe['pandoc_options'])
+        keys = [hashlib.blake2b((prefix + '\0' + section).encode(),
+                                digest_size=16).hexdigest()
+                for section in sections]
+        self.runConcurrently(
+            [functools.partial(self._convert_section, key, section)
+             for key, section in zip(keys, sections)
+             if key not in self._section_outputs],
+            os.cpu_count() or 1)
+        if any(key not in self._section_outputs for key in keys):
+            return None
+        # Drop sections which are no longer in the document.
+        self._section_outputs = {key: self._section_outputs[key]
+                                 for key in keys}
+        return b''.join(self._section_outputs[key] for key in keys)
+
+    def _verify_sections(self, sections: List[str]) -> None:
+        # Sections are only used once they've been seen to give exactly
+        # what the whole document did.
+        output = self._convert_sections(sections)
+        if output is None:
+            return
+        with open(self.outputName, 'rb') as fd:
+            self._sections_verified = fd.read() == output
+        if not self._sections_verified:
+            print("Sections of", self.recipe['file'],
+                  "convert differently on their own; building it whole.",
+                  file=sys.stderr)
+
     def pandoc(self):
+        key = None  # type: Optional[str]
+        if self.cache is not None:
+            key = self._cache_key(self.cache)
+        if self.cache is not None and key is not None:
+            if self.cache.restore(key, self.outputName):
+                print('Restored', self.recipe['file'], 'from cache.')
+                return
+            # outputName may be a hard link into the cache, and pandoc
+            # would overwrite the cached copy through it.
+            if os.path.lexists(self.outputName):
+                os.remove(self.outputName)
+
         print('Started building', self.recipe['file'] + '.')
-        subprocess.call(
-            ['pandoc'] + self.recipe['pandoc_options'] + [
-                '-o',
-                self.outputName,
-                self.recipe['file']
-            ]
-            )
+        returncode = None  # type: Optional[int]
+        sections = self._sections()
+        if sections is not None and self._sections_verified:
+            output = self._convert_sections(sections)
+            if output is not None:
+                self._write_output(output)
+                returncode = 0
+        if returncode is None:
+            # Also the way any section's errors get reported.
+            if self.recipe['server'] and self._server_convert():
+                returncode = 0
+            else:
+                returncode = self.call(
+                    ['pandoc'] + self.recipe['pandoc_options'] + [
+                        '-o',
+                        self.outputName,
+                        self.recipe['file']
+                    ]
+                    )
+            if sections is not None and returncode == 0 and \
+                    self._sections_verified is None:
+                self._verify_sections(sections)
         print('Finished building', self.recipe['file'] + '.')
 
+        # Only cache output that matches the input it was keyed on.
+        if self.cache is not None and key is not None and \
+                returncode == 0 and os.path.exists(self.outputName) and \
+                self._cache_key(self.cache, fresh=True) == key:
+            self.cache.store(key, self.outputName)
 
-def processargs(input_argv: List[str]) -> ProcessedArgs:
+
+def processargs(
+        input_argv: List[str], cwd: Optional[str] = None,
+        ) -> ProcessedArgs:
     processingArgs = shared_watch.ProcessArgs(
             input_argv,
             usage,
             PandocBuild,
-            "Pandoc"
+            "Pandoc",
+            cwd,
             )
 
     processingArgs.output_recipe['docx'] = False
     processingArgs.output_recipe['outputType'] = False
     processingArgs.output_recipe['pandoc_options'] = []
+    processingArgs.output_recipe['cache_size'] = 256
+    processingArgs.output_recipe['server'] = False
+    processingArgs.output_recipe['incremental'] = False
 
     def _output_type(i: int):
         if '=' in input_argv[i]:
@@ -94,6 +298,8 @@ def processargs(input_argv: List[str]) -> ProcessedArgs:
 
         processingArgs.output_recipe["outputType"] = out_type
         processingArgs.output["outputType"] = out_type
+    processingArgs.long_args_to_disc['--output-type'] = _output_type
+    processingArgs.short_args_to_disc['t'] = _output_type
 
     def _docx(i: int):
         processingArgs.output_recipe["docx"] = True
@@ -102,6 +308,24 @@ def processargs(input_argv: List[str]) -> ProcessedArgs:
     processingArgs.long_args_to_disc['--docx'] = _docx
     processingArgs.short_args_to_disc['d'] = _docx
 
+    def _cache_size(i: int):
+        if '=' in input_argv[i]:
+            cache_size = input_argv[i].split('=')[1]
+        else:
+            cache_size = input_argv[i + 1]
+            processingArgs.indexes_to_ignore.append(i + 1)
+
+        processingArgs.output_recipe["cache_size"] = int(cache_size)
+    processingArgs.long_args_to_disc['--cache-size'] = _cache_size
+
+    def _server(i: int):
+        processingArgs.output_recipe["server"] = True
+    processingArgs.long_args_to_disc['--server'] = _server
+
+    def _incremental(i: int):
+        processingArgs.output_recipe["incremental"] = True
+    processingArgs.long_args_to_disc['--incremental'] = _incremental
+
     return processingArgs.render_processargs()
 
 
@@ -123,30 +347,7 @@ class ShouldExit():
             return False
 
 
-class SwapFilesWatch():
-    _num_of_returns = 0
-    swapsToCheck = []  # type: List[str]
-
-    def __init__(self, primaryFile: str, extraFiles: List[str]) -> None:
-        self.swapsToCheck.append(os.path.join(os.path.dirname(primaryFile),
-                                 '.' + os.path.basename(primaryFile) + '.swp'))
-        for singleFile in extraFiles:
-            self.swapsToCheck.append(os.path.join(
-                os.path.dirname(singleFile),
-                '.' + os.path.basename(singleFile) +
-                '.swp'))
-
-    def swapFilesExist(self) -> bool:
-        result = bool()
-        for swap in self.swapsToCheck:
-            if os.path.exists(swap):
-                result = True
-                break
-
-        return result
-
-
-def main_for_file(args: ProcessedArgs) -> None:
+def prepare_for_file(args: ProcessedArgs) -> shared_watch.Watch:
     os.makedirs(os.path.expandvars(args['auxdir']), exist_ok=True)
     if args['slow']:
         pdfname = os.path.join(
@@ -160,27 +361,34 @@ def main_for_file(args: ProcessedArgs) -> None:
         pdfname = args['build'].pdfname
     print(pdfname)
     swapWatch = SwapFilesWatch(args['file'], args['extra_files'])
-    args['build'].build()
-    if not args['disable_viewer']:
-        try:
-            subprocess.call(['rifle', pdfname])
-        except FileNotFoundError:
-            print("rifle not installed", file=sys.stderr)
+
+    def open_viewer() -> None:
+        if not args['disable_viewer']:
+            try:
+                subprocess.call(['rifle', pdfname])
+            except FileNotFoundError:
+                print("rifle not installed", file=sys.stderr)
     if os.getenv('VIM', False):
-        return
+        return shared_watch.Watch(args['build'], None, open_viewer)
 
-    while swapWatch.swapFilesExist():
-        try:
-            if args['build'].hasAnythingChanged():
-                args['build'].build()
-            time.sleep(5)
-        except KeyboardInterrupt:
-            args['build'].build()
-
-    if args['build'].hasAnythingChanged():
-        args['build'].build()
-        if swapWatch.swapFilesExist():
-            main_for_file(args)
+    # Wake up when the swap files go away too, not only on edits.
+    for swap in swapWatch.swapsToCheck:
+        args['build'].watchPath(swap)
+
+    return shared_watch.Watch(
+        args['build'], swapWatch.swapFilesExist, open_viewer,
+        swapWatch.pathsChanged)
+
+
+def main_for_file(args: ProcessedArgs) -> None:
+    if os.getenv('VIM', False) and \
+            shared_watch.sendTrigger(args['auxdir'], args['file']):
+        # Run from the editor while a watch is already running, which
+        # starts the build straight away.
+        return
+    loop = shared_watch.WatchLoop(args['jobs'])
+    loop.add(prepare_for_file(args))
+    loop.run()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,116 @@
+import os
+import signal
+import subprocess
+import threading
+from typing import IO, Optional
+
+# Runs inside `sage -python`. Sage's own startup happens once, then each line
+# on stdin names a script to load in a fresh namespace. Statuses go back on
+# a separate pipe so whatever the script prints can't be mistaken for one.
+_WORKER = r'''
+import os, sys
+from sage.all import *
+from sage.repl.load import load as _load
+_base = dict(globals())
+_status = os.fdopen(int(sys.argv[1]), 'w')
+for _line in sys.stdin:
+    _directory, _name = _line.rstrip('\n').split('\0')
+    _code = 0
+    try:
+        os.chdir(_directory)
+        _load(_name, dict(_base))
+    except BaseException as e:
+        print(e, file=sys.stderr)
+        _code = 1
+    sys.stdout.flush()
+    _status.write('%d\n' % _code)
+    _status.flush()
+'''
+
+
+class SageWorker:
+    def __init__(self, sage: str) -> None:
+        self.sage = sage
+        self._lock = threading.Lock()
+        self._process = None  # type: Optional[subprocess.Popen]
+        self._status = None  # type: Optional[IO[str]]
+        # Set when a fresh worker dies before finishing anything, which
+        # means this sage can't run one at all.
+        self._unavailable = False
+        self._killed = False
+
+    def _start(self) -> bool:
+        read_fd, write_fd = os.pipe()
+        try:
+            self._process = subprocess.Popen(
+                [self.sage, '-python', '-u', '-c', _WORKER, str(write_fd)],
+                stdin=subprocess.PIPE,
+                universal_newlines=True,
+                pass_fds=(write_fd,),
+                start_new_session=True,
+            )
+        except OSError:
+            os.close(read_fd)
+            self._process = None
+            return False
+        finally:
+            os.close(write_fd)
+        self._status = os.fdopen(read_fd)
+        return True
+
+    def run(self, directory: str, script: str) -> Optional[int]:
+        # Returns the script's status, or None if the worker isn't usable
+        # and sage has to be run the ordinary way.
+        with self._lock:
+            if self._unavailable:
+                return None
+            fresh = False
+            self._killed = False
+            if self._process is None or self._process.poll() is not None:
+                if not self._start():
+                    self._unavailable = True
+                    return None
+                fresh = True
+            process, status = self._process, self._status
+            assert process is not None and process.stdin is not None
+            assert status is not None
+            try:
+                process.stdin.write(
+                    os.path.abspath(directory) + '\0' + script + '\n')
+                process.stdin.flush()
+                line = status.readline()
+            except (OSError, ValueError):
+                line = ''
+            if not line:
+                # The worker died, or was killed by a cancelled build.
+                self._stop()
+                self._unavailable = fresh and not self._killed
+                return None
+            return int(line)
+
+    def _stop(self) -> None:
+        if self._process is not None:
+            try:
+                os.killpg(self._process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            self._process.wait()
+            self._process = None
+        if self._status is not None:
+            self._status.close()
+            self._status = None
+
+    def close(self) -> None:
+        self.kill()
+        with self._lock:
+            self._stop()
+
+    def kill(self) -> None:
+        # Safe to call from another thread while run() is waiting.
+        self._killed = True
+        process = self._process
+        if process is not None:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
@@ -1,75 +1,1239 @@
+import fcntl
+import functools
+import hashlib
+import json
 import time
 import os
+import selectors
+import shutil
+import signal
+import subprocess
+import tempfile
 import sys
-from typing import List, Tuple, Dict, Any, Callable, NewType
+import threading
+import weakref
+import watch_backends
+import watch_fingerprint
+from typing import List, Tuple, Dict, Any, Callable, NewType, Optional, Set
+from typing import Iterable
 
 ProcessedArgs = Dict[str, Any]
 Recipe = NewType("Recipe", Dict[str, Any])
 MainForFileMethod = Callable[[ProcessedArgs], None]
 FilePair = Tuple[MainForFileMethod, ProcessedArgs]
+# Takes the paths a watcher reported, or None if it can't say.
+PathsCallback = Callable[[Optional[Set[str]]], None]
 
 
-class FileWatch:
-    _failed_reads = 0
+# Size of the chunks used to hash files, so large inputs are never held in
+# memory all at once.
+_HASH_CHUNK_SIZE = 1 << 20
+# A file modified this close to when we last stat()ed it could have been
+# written again within the same timestamp tick, so its stat isn't trusted.
+_RACY_WINDOW_NS = 2 * 10**9
+
+StatKey = Tuple[int, int, int, int]
+
+
+def _stat_key(st: os.stat_result) -> StatKey:
+    return (st.st_mtime_ns, st.st_size, st.st_ino, st.st_dev)
+
+
+def digestFile(file_name: str) -> bytes:
+    digest = hashlib.blake2b()
+    with open(file_name, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(_HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.digest()
 
+
+class FileWatch:
+    # Always goes by the path rather than an open file, so an editor saving
+    # by renaming a new file over the old one is followed: the inode in the
+    # stat key changes and the new file is hashed.
     def __init__(self, file_name: str) -> None:
         self._file_name = file_name
-        self._last_content = self._read_file()
+        self._last_stat = None  # type: Optional[StatKey]
+        self._last_digest = None  # type: Optional[bytes]
+        self._stat_time_ns = 0
+        # Bumped on every change, so each build sharing this watch can tell
+        # whether it has seen the latest content.
+        self.version = 0
+        # Only bumped when the content changed in a way that matters, for
+        # builds which asked for that, see normalise().
+        self.semanticVersion = 0
+        self._normalise = False
+        self._last_fingerprint = None  # type: Optional[bytes]
+        # Set while the file is missing, as it briefly is in the middle of
+        # some editors' saves. Nothing counts as changed until it is back.
+        self.pending = False
+        self._lock = threading.Lock()
+        read = self._read_file()
+        if read is None:
+            self.pending = True
+        else:
+            self._last_stat, self._last_digest = read
 
-    def _read_file(self) -> List[str]:
+    def _read_file(self) -> Optional[Tuple[StatKey, bytes]]:
+        # Returns None if the file isn't there, or was replaced by one which
+        # isn't there yet in between the stat() and the open().
         try:
-            fd = open(self._file_name)
-        except FileNotFoundError as e:
-            self._failed_reads += 1
-            if self._failed_reads <= 5:
-                time.sleep(.3)
-                return self._read_file()
-            else:
-                raise e
-        filecontents = fd.readlines()
-        fd.close()
-        return filecontents
+            self._stat_time_ns = time.time_ns()
+            key = _stat_key(os.stat(self._file_name))
+            digest = digestFile(self._file_name)
+        except FileNotFoundError:
+            return None
+        return key, digest
+
+    @property
+    def file_name(self) -> str:
+        return self._file_name
+
+    @property
+    def digest(self) -> Optional[bytes]:
+        return self._last_digest
+
+    def normalise(self) -> None:
+        # Starts keeping semanticVersion, which ignores edits such as to
+        # comments and trailing whitespace.
+        with self._lock:
+            if not self._normalise:
+                self._normalise = True
+                self._last_fingerprint = watch_fingerprint.fingerprint(
+                    self._file_name)
+
+    def _contentChanged(self) -> None:
+        self.version += 1
+        if not self._normalise:
+            self.semanticVersion += 1
+            return
+        fingerprint = watch_fingerprint.fingerprint(self._file_name)
+        if fingerprint is None or fingerprint != self._last_fingerprint:
+            self.semanticVersion += 1
+        self._last_fingerprint = fingerprint
+
+    def _stat_is_ambiguous(self) -> bool:
+        if self._last_stat is None:
+            return True
+        return self._stat_time_ns - self._last_stat[0] < _RACY_WINDOW_NS
 
     def hasItChanged(self) -> bool:
-        self._failed_reads = 0
-        _new_content = self._read_file()
-        if _new_content != self._last_content:
-            self._last_content = _new_content
+        with self._lock:
+            try:
+                key = _stat_key(os.stat(self._file_name))
+            except FileNotFoundError:
+                self.pending = True
+                return False
+            if key == self._last_stat and not self._stat_is_ambiguous():
+                self.pending = False
+                return False
+
+            read = self._read_file()
+            if read is None:
+                self.pending = True
+                return False
+            self.pending = False
+            _new_stat, _new_digest = read
+            # Already counted by markChanged(), which didn't hash it.
+            marked = self._last_digest is None and \
+                _new_stat == self._last_stat
+            self._last_stat = _new_stat
+            if _new_digest != self._last_digest and not marked:
+                self._last_digest = _new_digest
+                self._contentChanged()
+                return True
+            else:
+                self._last_digest = _new_digest
+                if marked and self._normalise:
+                    self._last_fingerprint = \
+                        watch_fingerprint.fingerprint(self._file_name)
+                return False
+
+    def markChanged(self) -> bool:
+        # Told of a change by the editor, so take its word rather than
+        # hashing the file now. Returns False if the change was already
+        # noticed the usual way.
+        with self._lock:
+            try:
+                key = _stat_key(os.stat(self._file_name))
+            except FileNotFoundError:
+                self.pending = True
+                return False
+            if key == self._last_stat:
+                return False
+            self.pending = False
+            self._stat_time_ns = time.time_ns()
+            self._last_stat = key
+            self._last_digest = None
+            self.version += 1
+            self.semanticVersion += 1
             return True
-        else:
+
+
+class FileIndex:
+    # Process wide map from each physical file to its one FileWatch and the
+    # builds depending on it, so a file shared by many documents is only
+    # ever stat()ed and hashed once per change. The same goes for watching:
+    # every path is registered once, with one watcher for the process.
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._watches = {}  # type: Dict[str, FileWatch]
+        self._dependents = {}  # type: Dict[str, weakref.WeakSet]
+        # The builds watching each path, by absolute path.
+        self._watchers = {}  # type: Dict[str, weakref.WeakSet]
+        self._events = None  # type: Optional[watch_backends.InotifyWatcher]
+        self._no_events = False
+        self.poller = watch_backends.PollWatcher()
+        # Builds with any path in poller.
+        self._polled = weakref.WeakSet()  # type: weakref.WeakSet
+
+    def watch(self, file_name: str, build) -> FileWatch:
+        path = os.path.realpath(file_name)
+        with self._lock:
+            if path not in self._watches:
+                self._watches[path] = FileWatch(file_name)
+                self._dependents[path] = weakref.WeakSet()
+            self._dependents[path].add(build)
+            watch = self._watches[path]
+        if build.recipe.get('semantic', False):
+            watch.normalise()
+        return watch
+
+    def dependents(self, file_name: str) -> List[Any]:
+        with self._lock:
+            return list(self._dependents.get(
+                os.path.realpath(file_name), ()))
+
+    def get(self, file_name: str) -> Optional[FileWatch]:
+        with self._lock:
+            return self._watches.get(os.path.realpath(file_name))
+
+    @property
+    def events(self) -> Optional[watch_backends.InotifyWatcher]:
+        return self._events
+
+    def _addEventPath(self, path: str) -> bool:
+        if self._no_events or watch_backends.needsPolling(path):
+            # Changes made on other machines never raise events.
+            return False
+        try:
+            if self._events is None:
+                self._events = watch_backends.InotifyWatcher()
+            self._events.addPath(path)
+        except (OSError, AttributeError):
+            # No inotify on this platform, out of instances or watches, or
+            # a directory which can't be watched.
+            self._no_events = self._events is None
+            return False
+        return True
+
+    def watchPath(self, path: str, build, poll: bool = False) -> None:
+        path = os.path.abspath(path)
+        with self._lock:
+            builds = self._watchers.setdefault(path, weakref.WeakSet())
+            builds.add(build)
+            if not poll and self._addEventPath(path):
+                return
+            self.poller.addPath(path)
+            self._polled.add(build)
+
+    def unwatch(self, build, paths: Iterable[str]) -> None:
+        # Stops watching whichever of paths no other build is watching.
+        with self._lock:
+            for path in paths:
+                path = os.path.abspath(path)
+                builds = self._watchers.get(path)
+                if builds is None:
+                    continue
+                builds.discard(build)
+                if builds:
+                    continue
+                del self._watchers[path]
+                if self._events is not None:
+                    self._events.removePath(path)
+                self.poller.removePath(path)
+            self._polled.discard(build)
+
+    def watchers(self, path: str) -> List[Any]:
+        # Every build with an interest in path, whether as a watched path
+        # or as the same physical file under another name.
+        with self._lock:
+            builds = set(self._watchers.get(os.path.abspath(path), ()))
+            builds.update(self._dependents.get(os.path.realpath(path), ()))
+        return list(builds)
+
+    def isPolled(self, build) -> bool:
+        with self._lock:
+            return build in self._polled
+
+    def polledBuilds(self) -> List[Any]:
+        with self._lock:
+            return list(self._polled)
+
+    def readEvents(self) -> Set[str]:
+        with self._lock:
+            if self._events is None:
+                return set()
+            return self._events.wait(0)
+
+    def poll(self) -> Set[str]:
+        with self._lock:
+            return self.poller.poll()
+
+
+fileIndex = FileIndex()
+
+
+# From <linux/fs.h>: share the source's extents on btrfs, XFS and the like.
+_FICLONE = 0x40049409
+
+
+def _copy_data(source: str, destination: str) -> None:
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+            return
+        except OSError:
+            pass
+        try:
+            # Copies inside the kernel, without passing through userspace.
+            size = os.fstat(src.fileno()).st_size
+            copied = 0
+            while copied < size:
+                done = os.copy_file_range(
+                    src.fileno(), dst.fileno(), size - copied)
+                if done == 0:
+                    break
+                copied += done
+            if copied == size:
+                return
+        except (OSError, AttributeError):
+            pass
+        src.seek(0)
+        dst.seek(0)
+        dst.truncate()
+        shutil.copyfileobj(src, dst, _HASH_CHUNK_SIZE)
+
+
+def copyFileAtomically(source: str, destination: str) -> None:
+    # Readers of destination see either the old file or the new one, never
+    # a partly written one. The temporary name is unique so two threads
+    # copying to the same destination don't write into each other's copy.
+    fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(destination) or '.')
+    os.close(fd)
+    try:
+        _copy_data(source, tmp_name)
+        # mkstemp() makes it private to the user.
+        shutil.copymode(source, tmp_name)
+        os.replace(tmp_name, destination)
+    except BaseException:
+        os.remove(tmp_name)
+        raise
+
+
+def _link_or_copy(source: str, destination: str) -> None:
+    # Replaces destination atomically, sharing the inode when possible.
+    tmp_name = destination + '.tmp'
+    if os.path.lexists(tmp_name):
+        os.remove(tmp_name)
+    try:
+        os.link(source, tmp_name)
+    except OSError:
+        _copy_data(source, tmp_name)
+    os.replace(tmp_name, destination)
+
+
+class OutputCache:
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def key(self, *parts: str) -> str:
+        digest = hashlib.blake2b(digest_size=20)
+        for part in parts:
+            digest.update(part.encode() + b'\0')
+        return digest.hexdigest()
+
+    def _entry(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def restore(self, key: str, destination: str) -> bool:
+        entry = self._entry(key)
+        try:
+            # The mtime doubles as the last use for LRU eviction.
+            os.utime(entry)
+        except FileNotFoundError:
             return False
+        _link_or_copy(entry, destination)
+        return True
+
+    def store(self, key: str, source: str) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        _link_or_copy(source, self._entry(key))
+        self._evict()
+
+    def _evict(self) -> None:
+        entries = []  # type: List[Tuple[int, int, str]]
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                st = entry.stat()
+                entries.append((st.st_mtime_ns, st.st_size, entry.path))
+                total += st.st_size
+        entries.sort()
+        while total > self.max_bytes and entries:
+            _mtime, size, path = entries.pop(0)
+            os.remove(path)
+            total -= size
+
+
+MANIFEST_NAME = 'manifest.json'
+# Files in an auxdir which aren't build state.
+_UNSNAPSHOTTED = {'metrics.jsonl', 'trigger'}
+
+
+class AuxdirSnapshot:
+    # A copy of an auxdir kept somewhere that outlives /tmp, along with
+    # the digests of the inputs it was built from.
+    def __init__(self, auxdir: str, directory: str) -> None:
+        self.auxdir = auxdir
+        self.directory = directory
+        self.manifest_name = os.path.join(directory, MANIFEST_NAME)
+
+    def _manifest(self) -> Dict[str, Any]:
+        try:
+            with open(self.manifest_name) as fd:
+                return json.load(fd)
+        except (OSError, ValueError):
+            return {}
+
+    def restore(self, recipe: str) -> Optional[Dict[str, Optional[str]]]:
+        # Copies back whatever the auxdir is missing, if the snapshot was
+        # made with the same recipe. Returns the inputs the snapshot was
+        # built from if the auxdir had none of it, as after a reboot, so
+        # the caller can tell if it is still current.
+        manifest = self._manifest()
+        files = manifest.get('files', {})
+        if not files or manifest.get('recipe') != recipe:
+            return None
+        os.makedirs(self.auxdir, exist_ok=True)
+        cold = True
+        for name in files:
+            destination = os.path.join(self.auxdir, name)
+            if os.path.lexists(destination):
+                cold = False
+                continue
+            try:
+                copyFileAtomically(os.path.join(self.directory, name),
+                                   destination)
+            except FileNotFoundError:
+                return None
+        return manifest.get('inputs') if cold else None
+
+    def save(self, inputs: Dict[str, Optional[str]], recipe: str) -> None:
+        # Only files which changed since the last snapshot are copied.
+        old = self._manifest().get('files', {})
+        files = {}  # type: Dict[str, List[int]]
+        os.makedirs(self.directory, exist_ok=True)
+        with os.scandir(self.auxdir) as it:
+            for entry in it:
+                if entry.name in _UNSNAPSHOTTED or \
+                        entry.name.endswith('.tmp') or \
+                        not entry.is_file(follow_symlinks=False):
+                    continue
+                st = entry.stat()
+                files[entry.name] = [st.st_mtime_ns, st.st_size]
+                if old.get(entry.name) != files[entry.name]:
+                    copyFileAtomically(
+                        entry.path, os.path.join(self.directory, entry.name))
+        for name in old:
+            if name not in files:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+        tmp_name = self.manifest_name + '.tmp'
+        with open(tmp_name, 'w') as fd:
+            json.dump({'files': files, 'inputs': inputs, 'recipe': recipe},
+                      fd)
+        os.replace(tmp_name, self.manifest_name)
+
+
+def documentAuxdir(base: str, file_name: str) -> str:
+    # One auxdir per document, so documents with the same name in
+    # different directories don't overwrite each other's files.
+    path = os.path.abspath(file_name)
+    return os.path.join(base, '%s-%s' % (
+        os.path.splitext(os.path.basename(path))[0],
+        hashlib.blake2b(path.encode(), digest_size=6).hexdigest()))
+
+
+class BuildCancelled(Exception):
+    pass
+
+
+class BuildFailed(Exception):
+    # Raised by a step which knows the rest of the build can't succeed.
+    pass
+
+
+_metrics_lock = threading.Lock()
+
+
+def appendMetrics(metrics_name: str, record: Dict[str, Any]) -> None:
+    line = json.dumps(record, sort_keys=True) + '\n'
+    with _metrics_lock:
+        os.makedirs(os.path.dirname(metrics_name) or '.', exist_ok=True)
+        with open(metrics_name, 'a') as fd:
+            fd.write(line)
+
+
+class Step:
+    # A build step and the files it reads and writes. Steps which neither
+    # name each other in after nor touch each other's files may run at once.
+    def __init__(
+            self, run: Callable[[], Any],
+            inputs: Iterable[str] = (),
+            outputs: Iterable[str] = (),
+            after: Iterable[str] = (),
+            ) -> None:
+        self.run = run
+        self.name = run.__name__
+        self.inputs = set(inputs)
+        self.outputs = set(outputs)
+        self.after = set(after)
+
+    def dependsOn(self, other: 'Step') -> bool:
+        return other.name in self.after or \
+            bool(other.outputs & (self.inputs | self.outputs)) or \
+            bool(self.outputs & other.inputs)
 
 
 class Build:
-    build_steps = []  # type: List[object]
-    watchedFiles = []  # type: List[FileWatch]
+    # Seconds without further events before a burst of writes counts as one.
+    debounce = 0.1
+
+    def __init__(self, recipe: Recipe) -> None:
+        self.recipe = recipe
+        self._cancelled = threading.Event()
+        self._process_lock = threading.Lock()
+        self._processes = set()  # type: Set[subprocess.Popen]
+        # Per-thread totals, which each step's metrics are taken as
+        # differences of, so steps running at once don't count each other.
+        self._totals = threading.local()
+        # When the oldest change not yet built was first noticed.
+        self.changeDetectedAt = None  # type: Optional[float]
+        # Why the last build stopped early, if it did.
+        self.lastError = None  # type: Optional[Exception]
+        self.metricsName = os.path.join(
+            recipe.get('auxdir', '.'), 'metrics.jsonl')
+        self.build_steps = []  # type: List[Callable[[], Any]]
+        self.watchedFiles = []  # type: List[FileWatch]
+        # The FileWatch.version of each watched file as of the last check.
+        self._seen_versions = {}  # type: Dict[FileWatch, int]
+        self.watchedPaths = set()  # type: Set[str]
+        self.snapshot = None  # type: Optional[AuxdirSnapshot]
+        # What the restored auxdir was built from, until the first build.
+        self._restored_inputs = None  # type: Optional[Dict[str, Any]]
+        if recipe.get('state'):
+            self.snapshot = AuxdirSnapshot(recipe['auxdir'], recipe['state'])
+            try:
+                self._restored_inputs = self.snapshot.restore(
+                    self.recipeKey())
+            except OSError:
+                pass
 
     def addWatchedFile(self, fileToAdd: str):
-        self.watchedFiles.append(FileWatch(fileToAdd))
+        if fileToAdd in self.watchedPaths:
+            return
+        watch = fileIndex.watch(fileToAdd, self)
+        if watch in self._seen_versions:
+            return
+        self._seen_versions[watch] = self._versionOf(watch)
+        self.watchedFiles.append(watch)
+        self.watchPath(fileToAdd)
+
+    def watchPath(self, path: str) -> None:
+        self.watchedPaths.add(path)
+        fileIndex.watchPath(path, self, self.recipe.get('poll', False))
+
+    def close(self) -> None:
+        # For a build nothing is going to watch any more.
+        fileIndex.unwatch(self, self.watchedPaths)
+
+    def changeSeen(self, watch: FileWatch) -> None:
+        # For a change this build is being started for directly, so that
+        # noticing it again later doesn't build twice.
+        if watch in self._seen_versions:
+            self._seen_versions[watch] = self._versionOf(watch)
+            if self.changeDetectedAt is None:
+                self.changeDetectedAt = time.time()
+
+    def waitForChange(self, timeout: Optional[float] = None) -> Set[str]:
+        # For a build used on its own. A WatchLoop reads the shared
+        # watchers itself and hands each build its share.
+        watcher = fileIndex.events  # type: Any
+        if watcher is None or fileIndex.isPolled(self):
+            watcher = fileIndex.poller
+        return {path for path in watcher.wait(timeout)
+                if self in fileIndex.watchers(path)}
+
+    def _versionOf(self, watch: FileWatch) -> int:
+        if self.recipe.get('semantic', False):
+            return watch.semanticVersion
+        return watch.version
 
     def hasAnythingChanged(self):
         _cache = []
         for i in self.watchedFiles:
-            _cache.append(i.hasItChanged())
+            # Another build may already have noticed this change, so go by
+            # the version rather than hasItChanged()'s answer.
+            i.hasItChanged()
+            version = self._versionOf(i)
+            _cache.append(version != self._seen_versions[i])
+            self._seen_versions[i] = version
         if True in _cache:
+            if self.changeDetectedAt is None:
+                self.changeDetectedAt = time.time()
             return True
         else:
             return False
 
-    def build(self):
-        for i in self.build_steps:
-            i()
+    def call(
+            self, args: List[str], cwd: Optional[str] = None,
+            output: Optional[Callable[[str], bool]] = None,
+            ) -> int:
+        # Each command gets its own process group so a cancelled build can
+        # take down anything the command itself started. If output is given
+        # it sees each line the command prints, and stops the command by
+        # returning True. Commands run in the recipe's cwd unless told
+        # otherwise.
+        if cwd is None:
+            cwd = self.recipe.get('cwd')
+        with self._process_lock:
+            # Checked under the lock: cancel() sets the flag before taking
+            # it, so either it is seen here or cancel() sees the process.
+            self.checkCancelled()
+            process = subprocess.Popen(
+                args, cwd=cwd, start_new_session=True,
+                stdout=None if output is None else subprocess.PIPE,
+                universal_newlines=True, errors='replace')
+            self._processes.add(process)
+        try:
+            if output is not None:
+                assert process.stdout is not None
+                stopped = False
+                for line in process.stdout:
+                    sys.stdout.write(line)
+                    if not stopped and output(line):
+                        stopped = True
+                        try:
+                            os.killpg(process.pid, signal.SIGTERM)
+                        except ProcessLookupError:
+                            pass
+                sys.stdout.flush()
+                process.stdout.close()
+            # wait4() rather than wait() to get this child's CPU time.
+            _pid, status, usage = os.wait4(process.pid, 0)
+            returncode = os.waitstatus_to_exitcode(status)
+            process.returncode = returncode
+        finally:
+            with self._process_lock:
+                self._processes.discard(process)
+        totals = self._threadTotals()
+        totals.child_cpu += usage.ru_utime + usage.ru_stime
+        self.recordStatus(returncode)
+        self.checkCancelled()
+        return returncode
+
+    def _threadTotals(self) -> threading.local:
+        totals = self._totals
+        if not hasattr(totals, 'child_cpu'):
+            totals.child_cpu = 0.0
+            totals.failures = 0
+            totals.last_failure = 0
+        return totals
+
+    def recordStatus(self, returncode: int) -> None:
+        if returncode != 0:
+            totals = self._threadTotals()
+            totals.failures += 1
+            totals.last_failure = returncode
+
+    def checkCancelled(self) -> None:
+        if self._cancelled.is_set():
+            raise BuildCancelled()
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+        with self._process_lock:
+            for process in self._processes:
+                try:
+                    os.killpg(process.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+    def clearCancel(self) -> None:
+        self._cancelled.clear()
+
+    def runStep(self, step: Callable[[], Any]) -> Any:
+        totals = self._threadTotals()
+        started = time.perf_counter()
+        child_cpu = totals.child_cpu
+        thread_cpu = time.thread_time()
+        failures = totals.failures
+        status = 'cancelled'  # type: Any
+        try:
+            result = step()
+            status = 0
+            if totals.failures != failures:
+                status = totals.last_failure
+            return result
+        except BuildFailed:
+            status = totals.last_failure \
+                if totals.failures != failures else 'failed'
+            raise
+        finally:
+            appendMetrics(self.metricsName, {
+                'time': time.time(),
+                'document': self.recipe.get('file', ''),
+                'step': step.__name__,
+                'wall': time.perf_counter() - started,
+                'cpu': totals.child_cpu - child_cpu +
+                time.thread_time() - thread_cpu,
+                'status': status,
+            })
+
+    def runConcurrently(
+            self, calls: List[Callable[[], Any]], jobs: int,
+            ) -> None:
+        # Runs the calls on up to jobs threads, counting what their
+        # commands cost towards the step this was called from.
+        waiting = list(reversed(calls))
+        lock = threading.Lock()
+        errors = []  # type: List[BaseException]
+        totals = []  # type: List[Tuple[float, int, int]]
+
+        def work() -> None:
+            while True:
+                with lock:
+                    if not waiting or errors:
+                        break
+                    call = waiting.pop()
+                try:
+                    call()
+                except BaseException as e:
+                    with lock:
+                        errors.append(e)
+            theirs = self._threadTotals()
+            with lock:
+                totals.append((theirs.child_cpu, theirs.failures,
+                               theirs.last_failure))
+        threads = [threading.Thread(target=work)
+                   for _ in range(min(jobs, len(calls)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        mine = self._threadTotals()
+        for child_cpu, failures, last_failure in totals:
+            mine.child_cpu += child_cpu
+            if failures:
+                mine.failures += failures
+                mine.last_failure = last_failure
+        if errors:
+            # A cancellation stops every call, so report that first.
+            for error in errors:
+                if isinstance(error, BuildCancelled):
+                    raise error
+            raise errors[0]
+
+    def runSteps(self, steps: List[Step]) -> None:
+        # Runs the steps in waves: each wave is every step that doesn't
+        # depend on one still waiting, and the wave is joined before the
+        # next starts.
+        waiting = list(steps)
+        while waiting:
+            wave = [step for i, step in enumerate(waiting)
+                    if not any(step.dependsOn(earlier)
+                               for earlier in waiting[:i])]
+            waiting = [step for step in waiting if step not in wave]
+            self.runConcurrently(
+                [functools.partial(self.runStep, step.run) for step in wave],
+                len(wave))
+
+    def inputDigests(self) -> Dict[str, Optional[str]]:
+        digests = {}  # type: Dict[str, Optional[str]]
+        for watch in self.watchedFiles:
+            digest = watch.digest
+            if digest is None:
+                # Marked as changed without being hashed yet.
+                try:
+                    digest = digestFile(watch.file_name)
+                except FileNotFoundError:
+                    pass
+            digests[os.path.abspath(watch.file_name)] = \
+                None if digest is None else digest.hex()
+        return digests
+
+    def recipeKey(self) -> str:
+        # Everything besides the inputs which decides what gets built.
+        return hashlib.blake2b(json.dumps(
+            [type(self).__name__] +
+            sorted((name, value) for name, value in self.recipe.items()
+                   if name != 'state'),
+            default=str).encode(), digest_size=16).hexdigest()
+
+    def outputs(self) -> List[str]:
+        # What a build makes, for subclasses to fill in.
+        return []
+
+    def _isCurrent(self, inputs: Dict[str, Optional[str]]) -> bool:
+        # Whether an auxdir built from inputs is what building now would
+        # make. Its inputs are watched either way, as the build would have.
+        for file_name in inputs:
+            if os.path.exists(file_name):
+                self.addWatchedFile(file_name)
+        return inputs == self.inputDigests() and \
+            all(os.path.exists(output) for output in self.outputs())
+
+    def build(self) -> bool:
+        self.lastError = None
+        restored, self._restored_inputs = self._restored_inputs, None
+        if restored is not None and self._isCurrent(restored):
+            # The restored auxdir is already what building would make.
+            print('Restored', self.recipe.get('file', ''), 'from snapshot.')
+            return True
+        failures = self._threadTotals().failures
+        try:
+            for i in self.build_steps:
+                self.runStep(i)
+        except BuildCancelled:
+            return False
+        except BuildFailed as e:
+            self.lastError = e
+            print(e, file=sys.stderr)
+        if self.snapshot is not None and self.lastError is None and \
+                self._threadTotals().failures == failures:
+            try:
+                self.snapshot.save(self.inputDigests(), self.recipeKey())
+            except OSError:
+                # Only costs a warm start next time.
+                pass
+        if self.changeDetectedAt is not None:
+            appendMetrics(self.metricsName, {
+                'time': time.time(),
+                'document': self.recipe.get('file', ''),
+                'step': 'latency',
+                'wall': time.time() - self.changeDetectedAt,
+            })
+            self.changeDetectedAt = None
+        return True
 
     def addToBuild(self, nameOfCompilationStep):
         self.build_steps.append(self.build_map[nameOfCompilationStep])
 
 
+class SwapFilesWatch():
+    def __init__(self, primaryFile: str, extraFiles: List[str]) -> None:
+        self.swapsToCheck = []  # type: List[str]
+        self.swapsToCheck.append(os.path.join(os.path.dirname(primaryFile),
+                                 '.' + os.path.basename(primaryFile) + '.swp'))
+        for singleFile in extraFiles:
+            self.swapsToCheck.append(os.path.join(
+                os.path.dirname(singleFile),
+                '.' + os.path.basename(singleFile) +
+                '.swp'))
+        self._present = {os.path.abspath(swap) for swap in self.swapsToCheck
+                         if os.path.lexists(swap)}
+
+    def pathsChanged(self, paths: Optional[Set[str]]) -> None:
+        # With None every swap file has to be looked at again.
+        for swap in self.swapsToCheck:
+            swap = os.path.abspath(swap)
+            if paths is not None and swap not in paths:
+                continue
+            if os.path.lexists(swap):
+                self._present.add(swap)
+            else:
+                self._present.discard(swap)
+
+    def swapFilesExist(self) -> bool:
+        return bool(self._present)
+
+
+class Watch:
+    def __init__(
+            self, build: Build,
+            keepWatching: Optional[Callable[[], bool]],
+            afterFirstBuild: Optional[Callable[[], None]] = None,
+            pathsChanged: Optional[PathsCallback] = None,
+            ) -> None:
+        # keepWatching is None for a build which only runs once.
+        self.build = build
+        self.keepWatching = keepWatching
+        self.afterFirstBuild = afterFirstBuild
+        self.pathsChanged = pathsChanged
+
+
+TRIGGER_NAME = 'trigger'
+
+
+def triggerPath(auxdir: str) -> str:
+    return os.path.join(auxdir, TRIGGER_NAME)
+
+
+def sendTrigger(auxdir: str, file_name: str) -> bool:
+    # Tells whatever is watching auxdir that file_name was just saved.
+    # Returns False, without blocking, if nothing is listening.
+    try:
+        fd = os.open(triggerPath(auxdir), os.O_WRONLY | os.O_NONBLOCK)
+    except OSError:
+        return False
+    try:
+        os.write(fd, (os.path.abspath(file_name) + '\n').encode())
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+    return True
+
+
+class TriggerChannel:
+    # A FIFO in the auxdir which an editor writes saved paths to, one per
+    # line, e.g. from a BufWritePost hook running the watcher with $VIM
+    # set, so builds start without waiting on change detection.
+    def __init__(self, auxdir: str) -> None:
+        self.path = triggerPath(auxdir)
+        os.makedirs(auxdir, exist_ok=True)
+        try:
+            os.mkfifo(self.path, 0o600)
+        except FileExistsError:
+            pass
+        self._fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+        # Held open so the FIFO doesn't read as closed between writers.
+        self._keep_open = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+        self._partial = b''
+
+    def fileno(self) -> int:
+        return self._fd
+
+    def read(self) -> List[str]:
+        try:
+            data = os.read(self._fd, 1 << 16)
+        except BlockingIOError:
+            return []
+        lines = (self._partial + data).split(b'\n')
+        self._partial = lines.pop()
+        return [line.decode(errors='replace') for line in lines if line]
+
+    def close(self) -> None:
+        os.close(self._fd)
+        os.close(self._keep_open)
+
+
+class BuildPool:
+    def __init__(self, jobs: int) -> None:
+        self._condition = threading.Condition()
+        # Queued builds and when their input was last edited; the most
+        # recently edited document is built first.
+        self._queued = {}  # type: Dict[Build, float]
+        self._after = {}  # type: Dict[Build, Callable[[], None]]
+        self._running = set()  # type: Set[Build]
+        # Builds to close once they are neither queued nor running.
+        self._closing = set()  # type: Set[Build]
+        for _ in range(jobs):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def submit(
+            self, build: Build,
+            after: Optional[Callable[[], None]] = None,
+            ) -> None:
+        with self._condition:
+            if build in self._running:
+                # Whatever it is building is already out of date.
+                build.cancel()
+            self._queued[build] = time.monotonic()
+            if after is not None:
+                self._after[build] = after
+            self._closing.discard(build)
+            self._condition.notify_all()
+
+    def _next(self) -> Optional[Build]:
+        ready = [build for build in self._queued
+                 if build not in self._running]
+        if not ready:
+            return None
+        return max(ready, key=lambda build: self._queued[build])
+
+    def _work(self) -> None:
+        while True:
+            with self._condition:
+                build = self._next()
+                while build is None:
+                    self._condition.wait()
+                    build = self._next()
+                del self._queued[build]
+                after = self._after.pop(build, None)
+                build.clearCancel()
+                self._running.add(build)
+            try:
+                if build.build():
+                    if after is not None:
+                        after()
+                elif after is not None:
+                    # Cancelled for a newer change; the rebuild it was
+                    # resubmitted for does this instead.
+                    with self._condition:
+                        self._after.setdefault(build, after)
+            except Exception as e:
+                # Such as a missing engine. This document's build failed,
+                # but the worker carries on with everyone else's.
+                build.lastError = e
+                print(e, file=sys.stderr)
+            finally:
+                with self._condition:
+                    self._running.discard(build)
+                    closing = build in self._closing and \
+                        build not in self._queued
+                    self._closing.discard(build)
+                    self._condition.notify_all()
+                if closing:
+                    build.close()
+
+    def close(self, build: Build) -> None:
+        # Closes build now, or after whatever it has left to build.
+        with self._condition:
+            if build in self._running or build in self._queued:
+                self._closing.add(build)
+                return
+        build.close()
+
+    def state(self, build: Build) -> str:
+        with self._condition:
+            if build in self._running:
+                return 'building'
+            if build in self._queued:
+                return 'queued'
+            return 'idle'
+
+    def join(self) -> None:
+        with self._condition:
+            while self._queued or self._running:
+                self._condition.wait()
+
+
+class WatchLoop:
+    def __init__(self, jobs: Optional[int] = None) -> None:
+        self.pool = BuildPool(jobs or os.cpu_count() or 1)
+        self._selector = selectors.DefaultSelector()
+        self._watches = []  # type: List[Watch]
+        self._watch_of_build = {}  # type: Dict[Build, Watch]
+        # The process wide event watcher, once registered with the selector.
+        self._events = None  # type: Optional[watch_backends.InotifyWatcher]
+        # When each watch should next be checked for changes, and when the
+        # process wide poller should next poll.
+        self._due = {}  # type: Dict[Watch, float]
+        self._poll_due = None  # type: Optional[float]
+        # Watchers whose events are handed straight to a callback, along
+        # with when the polled ones are due.
+        self._listeners = {}  # type: Dict[Any, PathsCallback]
+        self._listeners_due = {}  # type: Dict[Any, float]
+        # Anything else selectable, such as a socket, and what to call when
+        # it is ready to read.
+        self._readers = {}  # type: Dict[Any, Callable[[], None]]
+        self._triggers = {}  # type: Dict[str, TriggerChannel]
+
+    def add(self, watch: Watch) -> None:
+        self.pool.submit(watch.build, watch.afterFirstBuild)
+        if watch.keepWatching is not None:
+            self._watches.append(watch)
+            self._watch_of_build[watch.build] = watch
+            # Checked straight away rather than on the first change, so a
+            # document which isn't open anywhere is built once and left.
+            self._due[watch] = time.monotonic()
+            self._listenForTriggers(watch.build.recipe.get('auxdir'))
+
+    def _listenForTriggers(self, auxdir: Optional[str]) -> None:
+        if auxdir is None:
+            return
+        auxdir = os.path.abspath(auxdir)
+        if auxdir in self._triggers:
+            return
+        try:
+            channel = TriggerChannel(auxdir)
+        except OSError:
+            # Not a filesystem which can hold a FIFO; events still work.
+            return
+        self._triggers[auxdir] = channel
+        self.addReader(channel, lambda: self.trigger(channel.read()))
+
+    def trigger(self, paths: List[str]) -> None:
+        # Builds everything depending on paths now, without debouncing or
+        # checking what changed.
+        for path in paths:
+            fileWatch = fileIndex.get(path)
+            if fileWatch is None or not fileWatch.markChanged():
+                continue
+            for build in fileIndex.dependents(path):
+                watch = self._watch_of_build.get(build)
+                if watch is None:
+                    continue
+                build.changeSeen(fileWatch)
+                self._due.pop(watch, None)
+                self.pool.submit(build)
+
+    def isWatching(self, watch: Watch) -> bool:
+        return watch in self._watches
+
+    def removeListener(self, watcher) -> None:
+        del self._listeners[watcher]
+        if watcher in self._listeners_due:
+            del self._listeners_due[watcher]
+        else:
+            self._selector.unregister(watcher)
+
+    def addListener(self, watcher, callback: PathsCallback) -> None:
+        self._listeners[watcher] = callback
+        if hasattr(watcher, 'fileno'):
+            self._selector.register(watcher, selectors.EVENT_READ, callback)
+        else:
+            self._listeners_due[watcher] = time.monotonic() + watcher.interval
+
+    def addReader(self, fileobj, callback: Callable[[], None]) -> None:
+        self._readers[fileobj] = callback
+        self._selector.register(fileobj, selectors.EVENT_READ, callback)
+
+    def watches(self) -> List[Watch]:
+        return list(self._watches)
+
+    def remove(self, watch: Watch) -> None:
+        if watch in self._watches:
+            self._remove(watch)
+
+    def _remove(self, watch: Watch) -> None:
+        self._watches.remove(watch)
+        self._watch_of_build.pop(watch.build, None)
+        self._due.pop(watch, None)
+        # Otherwise a long running daemon keeps an inotify watch, a Sage
+        # process and a FIFO for every document it ever watched.
+        self.pool.close(watch.build)
+        auxdir = watch.build.recipe.get('auxdir')
+        if auxdir is None:
+            return
+        auxdir = os.path.abspath(auxdir)
+        if auxdir in self._triggers and not any(
+                os.path.abspath(other.build.recipe.get('auxdir', '')) == auxdir
+                for other in self._watches):
+            channel = self._triggers.pop(auxdir)
+            del self._readers[channel]
+            self._selector.unregister(channel)
+            channel.close()
+
+    def _sync(self) -> None:
+        # The shared watchers only come into being once something is
+        # watched through them.
+        events = fileIndex.events
+        if events is not None and self._events is not events:
+            self._selector.register(events, selectors.EVENT_READ, None)
+            self._events = events
+        if fileIndex.poller.watching:
+            if self._poll_due is None:
+                self._poll_due = time.monotonic() + fileIndex.poller.interval
+        else:
+            self._poll_due = None
+
+    def _check(self, watch: Watch) -> None:
+        if watch.build.hasAnythingChanged():
+            self.pool.submit(watch.build)
+        keepWatching = watch.keepWatching
+        if keepWatching is None or not keepWatching():
+            self._remove(watch)
+
+    def _pathsChanged(self, changed: Set[str]) -> None:
+        # Hands each watch its share of what changed, then waits out the
+        # rest of the burst before building.
+        shares = {}  # type: Dict[Watch, Set[str]]
+        for path in changed:
+            for build in fileIndex.watchers(path):
+                watch = self._watch_of_build.get(build)
+                if watch is not None:
+                    shares.setdefault(watch, set()).add(path)
+        now = time.monotonic()
+        for watch, paths in shares.items():
+            if watch.pathsChanged is not None:
+                watch.pathsChanged(paths)
+            self._due[watch] = now + watch.build.debounce
+
+    def _poll(self) -> None:
+        changed = fileIndex.poll()
+        self._pathsChanged(changed)
+        if fileIndex.poller.active:
+            # Files changed too recently for their stat() to be trusted
+            # need a closer look, even if the poll saw nothing.
+            now = time.monotonic()
+            for build in fileIndex.polledBuilds():
+                watch = self._watch_of_build.get(build)
+                if watch is not None:
+                    self._due.setdefault(watch, now)
+        self._poll_due = time.monotonic() + fileIndex.poller.interval
+
+    def run(self) -> None:
+        while self._watches or self._listeners or \
+                set(self._readers) - set(self._triggers.values()):
+            try:
+                self._sync()
+                due = list(self._due.values()) + \
+                    list(self._listeners_due.values())
+                if self._poll_due is not None:
+                    due.append(self._poll_due)
+                timeout = None
+                if due:
+                    timeout = max(0, min(due) - time.monotonic())
+                for key, _ in self._selector.select(timeout):
+                    if key.fileobj is self._events:
+                        self._pathsChanged(fileIndex.readEvents())
+                    elif key.fileobj in self._readers:
+                        key.data()
+                    else:
+                        # A listener's watcher, see addListener().
+                        watcher = key.fileobj  # type: Any
+                        changed = watcher.wait(0)
+                        if changed:
+                            key.data(changed)
+                now = time.monotonic()
+                if self._poll_due is not None and self._poll_due <= now:
+                    self._poll()
+                for watcher, listener_due in list(
+                        self._listeners_due.items()):
+                    if listener_due <= now:
+                        changed = watcher.poll()
+                        self._listeners_due[watcher] = \
+                            now + watcher.interval
+                        if changed:
+                            self._listeners[watcher](changed)
+                for watch, watch_due in list(self._due.items()):
+                    if watch_due <= now:
+                        del self._due[watch]
+                        self._check(watch)
+            except KeyboardInterrupt:
+                if not self._watches:
+                    raise
+                for watch in self._watches:
+                    self.pool.submit(watch.build)
+        self.pool.join()
+
+
 class ProcessArgs:
     def __init__(
             self, argv: List[str],
             usage_func: Callable[[int, object], None],
             BuildClassToUse,
             file_auxdir_suffix: str,
+            cwd: Optional[str] = None,
             ) -> None:
 
         self.output = {
@@ -79,10 +1243,17 @@ class ProcessArgs:
             "file": '',
             "extra_files": [],
             "outputType": '',
+            "jobs": None,
         }  # type: Dict[str, Any]
 
         self.output_recipe = Recipe({
             'make': False,
+            'poll': False,
+            'semantic': False,
+            'state': None,
+            # Where the build's commands run, which isn't this process's
+            # working directory when run for a daemon client.
+            'cwd': os.getcwd() if cwd is None else cwd,
             'file': '',
             'extra_files': [],
         })
@@ -93,6 +1264,10 @@ class ProcessArgs:
                 '--no-pdf': self._disable_viewer,
                 '--files': self._extra_files,
                 '--make': self._make,
+                '--poll': self._poll,
+                '--jobs': self._jobs,
+                '--semantic': self._semantic,
+                '--state-dir': self._state_dir,
                 }
 
         self.short_args_to_disc = {
@@ -102,6 +1277,8 @@ class ProcessArgs:
                 'D': self._disable_viewer,
                 'f': self._extra_files,
                 'm': self._make,
+                'P': self._poll,
+                'j': self._jobs,
                 }
 
         self.input_argv = argv
@@ -113,6 +1290,11 @@ class ProcessArgs:
         self.output_recipe['auxdir'] = os.path.expandvars(
                 '/tmp/$USER-' + file_auxdir_suffix)
         self.output["name"] = os.path.basename(self.input_argv[0])
+        self.file_auxdir_suffix = file_auxdir_suffix
+        self.auxdir_given = False
+        self.state_dir = os.path.join(
+            os.getenv('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+            'file_watch')
 
     # All of these run in the same scope as processargs(). They make changes to
     # output.
@@ -125,6 +1307,33 @@ class ProcessArgs:
     def _make(self, i: int) -> None:
         self.output_recipe['make'] = True
 
+    def _poll(self, i: int) -> None:
+        self.output_recipe['poll'] = True
+
+    def _state_dir(self, i: int) -> None:
+        if '=' in self.input_argv[i]:
+            state_dir = self.input_argv[i].split('=')[1]
+        else:
+            state_dir = self.input_argv[i + 1]
+            self.indexes_to_ignore.append(i + 1)
+
+        self.state_dir = os.path.expandvars(os.path.expanduser(state_dir))
+
+    def _semantic(self, i: int) -> None:
+        self.output_recipe['semantic'] = True
+
+    def _jobs(self, i: int) -> None:
+        if '=' in self.input_argv[i]:
+            jobs = self.input_argv[i].split('=')[1]
+        else:
+            jobs = self.input_argv[i + 1]
+            self.indexes_to_ignore.append(i + 1)
+
+        if int(jobs) < 1:
+            print("--jobs must be at least 1", file=sys.stderr)
+            self.usage_func(1, self.output['name'])
+        self.output['jobs'] = int(jobs)
+
     def _slow(self, i: int) -> None:
         self.output['slow'] = True
 
@@ -154,6 +1363,7 @@ class ProcessArgs:
                 os.path.expanduser(auxdir)
                 )
         self.output["auxdir"] = os.path.expandvars(os.path.expanduser(auxdir))
+        self.auxdir_given = True
 
     # In place of a switch-case statement the following dictionaires link argv
     # entries to functions.
@@ -194,6 +1404,16 @@ class ProcessArgs:
                 else:
                     print("Error parsing arguments", file=sys.stderr)
                     self.usage_func(1, self.output['name'])
+        if not self.auxdir_given and self.output_recipe['file']:
+            # The default auxdir is split per document and kept across
+            # reboots; one given with --auxdir is used exactly as it is.
+            auxdir = documentAuxdir(
+                self.output_recipe['auxdir'], self.output_recipe['file'])
+            self.output_recipe['auxdir'] = auxdir
+            self.output['auxdir'] = auxdir
+            self.output_recipe['state'] = os.path.join(
+                self.state_dir, self.file_auxdir_suffix,
+                os.path.basename(auxdir))
         self.output['build'] = self.BuildClassToUse(self.output_recipe)
 
         return self.output
@@ -0,0 +1,302 @@
+import ctypes
+import ctypes.util
+import os
+import re
+import select
+import struct
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+# Flags from <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# Directories are watched rather than the files themselves, so that editors
+# which save by renaming a temporary file over the original are still seen.
+_DIR_MASK = (IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_CREATE |
+             IN_DELETE | IN_ONLYDIR)
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+# Filesystems where changes made elsewhere never raise inotify events, so
+# files on them have to be polled. Any FUSE filesystem counts too.
+_POLLED_FILESYSTEMS = {
+    'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', '9p', 'virtiofs', 'vboxsf',
+    'ceph', 'afs', 'lustre', 'gpfs', 'davfs', 'fuse', 'fuseblk',
+}
+_MOUNTINFO = '/proc/self/mountinfo'
+_OCTAL_ESCAPE = re.compile(r'\\([0-7]{3})')
+
+_mounts = None  # type: Optional[List[Tuple[str, str]]]
+
+_libc = None  # type: Optional[ctypes.CDLL]
+
+
+def _get_libc() -> ctypes.CDLL:
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    return _libc
+
+
+def _read_mounts() -> List[Tuple[str, str]]:
+    # Mount points and their filesystem types, longest mount point first.
+    mounts = []  # type: List[Tuple[str, str]]
+    try:
+        with open(_MOUNTINFO) as fd:
+            for line in fd:
+                fields = line.split()
+                try:
+                    separator = fields.index('-')
+                except ValueError:
+                    continue
+                mounts.append((
+                    _OCTAL_ESCAPE.sub(
+                        lambda match: chr(int(match.group(1), 8)),
+                        fields[4]),
+                    fields[separator + 1],
+                ))
+    except OSError:
+        pass
+    mounts.sort(key=lambda mount: len(mount[0]), reverse=True)
+    return mounts
+
+
+def filesystemType(path: str) -> str:
+    global _mounts
+    if _mounts is None:
+        _mounts = _read_mounts()
+    path = os.path.realpath(path)
+    for mount_point, fs_type in _mounts:
+        if path == mount_point or mount_point == '/' or \
+                path.startswith(mount_point + '/'):
+            return fs_type
+    return ''
+
+
+def needsPolling(path: str) -> bool:
+    fs_type = filesystemType(os.path.dirname(os.path.abspath(path)))
+    return fs_type in _POLLED_FILESYSTEMS or fs_type.startswith('fuse.')
+
+
+StatKey = Tuple[int, int, int]
+
+
+class PollWatcher:
+    # Reads each directory once per poll rather than stat()ing paths one by
+    # one, and only reports paths which actually changed. Polls every
+    # minimum seconds after a change, backing off to interval when idle.
+    def __init__(self, interval: float = 5, minimum: float = .25) -> None:
+        self.maximum = interval
+        self.minimum = minimum
+        self.interval = minimum
+        # Names of interest in each directory, or None for all of them.
+        self._names = {}  # type: Dict[str, Optional[Set[str]]]
+        self._keys = {}  # type: Dict[str, Dict[str, Optional[StatKey]]]
+
+    def addPath(self, path: str) -> None:
+        directory, name = os.path.split(os.path.abspath(path))
+        names = self._names.setdefault(directory, set())
+        if names is not None:
+            names.add(name)
+
+    def addDirectory(self, directory: str) -> None:
+        self._names[os.path.abspath(directory)] = None
+
+    def removePath(self, path: str) -> None:
+        directory, name = os.path.split(os.path.abspath(path))
+        names = self._names.get(directory)
+        if names is None:
+            return
+        names.discard(name)
+        if not names:
+            del self._names[directory]
+            self._keys.pop(directory, None)
+
+    @property
+    def watching(self) -> bool:
+        return bool(self._names)
+
+    @property
+    def active(self) -> bool:
+        # Whether anything changed recently enough to still poll quickly.
+        return self.interval < self.maximum
+
+    def _scan(self, directory: str, names: Optional[Set[str]],
+              ) -> Dict[str, Optional[StatKey]]:
+        keys = {}  # type: Dict[str, Optional[StatKey]]
+        if names is not None:
+            for name in names:
+                keys[os.path.join(directory, name)] = None
+        try:
+            it = os.scandir(directory)
+        except OSError:
+            return keys
+        with it:
+            for entry in it:
+                if names is not None and entry.name not in names:
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                keys[entry.path] = (st.st_mtime_ns, st.st_size, st.st_ino)
+        return keys
+
+    def poll(self) -> Set[str]:
+        changed = set()  # type: Set[str]
+        for directory, names in self._names.items():
+            keys = self._scan(directory, names)
+            previous = self._keys.get(directory)
+            self._keys[directory] = keys
+            if previous is None:
+                # First look at this directory.
+                continue
+            for path in set(keys) | set(previous):
+                if path not in previous and names is not None:
+                    # Only just added.
+                    continue
+                if keys.get(path) != previous.get(path):
+                    changed.add(path)
+        if changed:
+            self.interval = self.minimum
+        else:
+            self.interval = min(self.interval * 2, self.maximum)
+        return changed
+
+    def wait(self, timeout: Optional[float] = None) -> Set[str]:
+        if timeout is None or timeout > self.interval:
+            time.sleep(self.interval)
+        else:
+            time.sleep(timeout)
+        return self.poll()
+
+    def close(self) -> None:
+        pass
+
+
+class InotifyWatcher:
+    def __init__(self) -> None:
+        libc = _get_libc()
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._dir_of_wd = {}  # type: Dict[int, str]
+        self._wd_of_dir = {}  # type: Dict[str, int]
+        self._names = {}  # type: Dict[str, Set[str]]
+        # Directories where every entry is of interest, not just the
+        # registered names.
+        self._whole_dirs = set()  # type: Set[str]
+
+    def _add_watch(self, directory: str) -> None:
+        if directory in self._wd_of_dir:
+            return
+        wd = _get_libc().inotify_add_watch(
+            self._fd, os.fsencode(directory), _DIR_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), directory)
+        self._wd_of_dir[directory] = wd
+        self._dir_of_wd[wd] = directory
+
+    def addDirectory(self, directory: str) -> None:
+        directory = os.path.abspath(directory)
+        self._add_watch(directory)
+        self._whole_dirs.add(directory)
+
+    def addPath(self, path: str) -> None:
+        directory, name = os.path.split(os.path.abspath(path))
+        self._add_watch(directory)
+        self._names.setdefault(directory, set()).add(name)
+
+    def removePath(self, path: str) -> None:
+        directory, name = os.path.split(os.path.abspath(path))
+        names = self._names.get(directory)
+        if names is None:
+            return
+        names.discard(name)
+        if names or directory in self._whole_dirs:
+            return
+        del self._names[directory]
+        wd = self._wd_of_dir.pop(directory, None)
+        if wd is not None:
+            del self._dir_of_wd[wd]
+            _get_libc().inotify_rm_watch(self._fd, wd)
+
+    def _all_paths(self) -> Set[str]:
+        return {os.path.join(directory, name)
+                for directory, names in self._names.items()
+                for name in names} | self._whole_dirs
+
+    def _read_events(self) -> Set[str]:
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+        changed = set()  # type: Set[str]
+        offset = 0
+        while offset < len(data):
+            wd, mask, _cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                return self._all_paths()
+            if mask & IN_IGNORED:
+                directory = self._dir_of_wd.pop(wd, None)
+                if directory is not None:
+                    del self._wd_of_dir[directory]
+                    self._whole_dirs.discard(directory)
+                continue
+            directory = self._dir_of_wd.get(wd)
+            if directory is None:
+                continue
+            if directory in self._whole_dirs or \
+                    name in self._names.get(directory, ()):
+                changed.add(os.path.join(directory, name))
+        return changed
+
+    def wait(self, timeout: Optional[float] = None) -> Set[str]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = max(0, deadline - time.monotonic())
+            try:
+                ready, _, _ = select.select([self._fd], [], [], remaining)
+            except InterruptedError:
+                continue
+            if not ready:
+                return set()
+            changed = self._read_events()
+            if changed:
+                return changed
+
+    def fileno(self) -> int:
+        return self._fd
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+def newWatcher(poll: bool = False):
+    if poll:
+        return PollWatcher()
+    try:
+        return InotifyWatcher()
+    except (OSError, AttributeError):
+        # No inotify on this platform (or out of instances), keep polling.
+        return PollWatcher()
@@ -0,0 +1,207 @@
+import json
+import os
+import socket
+import sys
+import shared_watch
+from typing import List, Tuple, Dict, Any, Callable, Optional
+
+ProcessedArgs = Dict[str, Any]
+PrepareForFileMethod = Callable[[ProcessedArgs], shared_watch.Watch]
+FilePair = Tuple[PrepareForFileMethod, ProcessedArgs]
+
+# Options whose value is a path, which has to be made absolute before the
+# daemon, running somewhere else, sees it, and the other options which
+# take a value.
+_LONG_PATH_OPTIONS = ('--auxdir', '--files', '--state-dir')
+_SHORT_PATH_OPTIONS = 'af'
+_LONG_VALUE_OPTIONS = _LONG_PATH_OPTIONS + (
+    '--engine', '--max-passes', '--sage', '--jobs', '--output-type',
+    '--cache-size')
+_SHORT_VALUE_OPTIONS = _SHORT_PATH_OPTIONS + 'ejt'
+# How long a client gets to send its request before it is dropped.
+_CLIENT_TIMEOUT = 1
+
+
+def socketPath() -> str:
+    return os.path.expandvars('/tmp/$USER-file_watch.sock')
+
+
+def absoluteArgv(argv: List[str], cwd: str) -> List[str]:
+    def absolute(path: str) -> str:
+        return os.path.join(cwd, os.path.expandvars(os.path.expanduser(path)))
+
+    output = argv[:1]
+    # Whether the next argument is an option's value, and if so whether
+    # that value is a path.
+    takesValue = takesPath = False
+    for arg in argv[1:]:
+        if takesValue:
+            output.append(absolute(arg) if takesPath else arg)
+            takesValue = takesPath = False
+        elif arg[:2] == '--':
+            name, equals, value = arg.partition('=')
+            if equals:
+                if name in _LONG_PATH_OPTIONS:
+                    arg = name + '=' + absolute(value)
+            else:
+                takesValue = name in _LONG_VALUE_OPTIONS
+                takesPath = name in _LONG_PATH_OPTIONS
+            output.append(arg)
+        elif arg[0] == '-':
+            # As in ProcessArgs, a value follows a group of flags if any
+            # of them takes one.
+            takesValue = any(flag in _SHORT_VALUE_OPTIONS
+                             for flag in arg[1:])
+            takesPath = any(flag in _SHORT_PATH_OPTIONS for flag in arg[1:])
+            output.append(arg)
+        else:
+            output.append(absolute(arg))
+    return output
+
+
+def request(message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    # Returns None when there is no daemon to ask.
+    try:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    except OSError:
+        return None
+    with client:
+        try:
+            client.connect(socketPath())
+        except OSError:
+            return None
+        client.sendall(json.dumps(message).encode() + b'\n')
+        with client.makefile() as fd:
+            reply = fd.readline()
+    try:
+        return json.loads(reply)
+    except ValueError:
+        return None
+
+
+class WatchDaemon:
+    # Owns every watch and build for the user, so two sessions editing the
+    # same document share one watch rather than building it twice.
+    def __init__(
+            self,
+            loop: shared_watch.WatchLoop,
+            makePairs: Callable[[List[str], Optional[str]], List[FilePair]],
+            ) -> None:
+        self.loop = loop
+        self.makePairs = makePairs
+        # One watch per document, and what it was started with, so an
+        # identical request is answered with the existing watch.
+        self.watches = {}  # type: Dict[str, shared_watch.Watch]
+        self.keys = {}  # type: Dict[str, str]
+        path = socketPath()
+        if request({'command': 'ping'}) is not None:
+            print("file_watch daemon already running.", file=sys.stderr)
+            exit(1)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        os.chmod(path, 0o600)
+        self.server.listen()
+        loop.addReader(self.server, self.accept)
+
+    def accept(self) -> None:
+        client, _ = self.server.accept()
+        with client:
+            client.settimeout(_CLIENT_TIMEOUT)
+            try:
+                with client.makefile('rw') as fd:
+                    reply = self.handle(json.loads(fd.readline()))
+                    fd.write(json.dumps(reply) + '\n')
+            except (OSError, ValueError):
+                return
+
+    def handle(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        command = message.get('command')
+        if command == 'ping':
+            return {'ok': True}
+        if command == 'register':
+            # Builds run where the client was run from, so relative paths
+            # in the documents mean the same as when watched in-process.
+            cwd = message.get('cwd')
+            argv = [str(arg) for arg in message.get('argv', [])]
+            try:
+                pairs = self.makePairs(
+                    argv, None if cwd is None else str(cwd))
+            except SystemExit:
+                # Argument parsing gives up with usage() and exit(), which
+                # mustn't take the daemon and every other watch with it.
+                return {'ok': False,
+                        'error': 'invalid arguments: ' + ' '.join(argv[1:])}
+            return {'ok': True, 'documents': [
+                self.register(pair, bool(message.get('trigger')))
+                for pair in pairs]}
+        if command == 'unregister':
+            return {'ok': True,
+                    'documents': self.unregister(message.get('files', []))}
+        if command == 'status':
+            return {'ok': True, 'documents': self.status()}
+        return {'ok': False, 'error': 'unknown command %r' % command}
+
+    def register(self, pair: FilePair, trigger: bool = False) -> str:
+        # With trigger, as sent from an editor's save hook, a document
+        # which is already watched is rebuilt straight away.
+        args = pair[1]
+        # Most options only show up in the build's recipe.
+        key = json.dumps(
+            [pair[0].__module__] +
+            sorted((name, value) for name, value in args.items()
+                   if name != 'build') +
+            sorted(args['build'].recipe.items()),
+            default=str)
+        file_name = os.path.abspath(args['file'])
+        watch = self.watches.get(file_name)
+        if watch is not None and self.loop.isWatching(watch):
+            if self.keys[file_name] == key:
+                # Already watched with the same recipe; this one isn't
+                # needed.
+                args['build'].close()
+                if trigger:
+                    self.loop.trigger([file_name])
+                return file_name
+            # Watched with other options, or from somewhere else. Both
+            # would build into the document's one auxdir, so the newer
+            # request replaces the older.
+            self.loop.remove(watch)
+        watch = pair[0](args)
+        self.watches[file_name] = watch
+        self.keys[file_name] = key
+        self.loop.add(watch)
+        return file_name
+
+    def unregister(self, files: List[str]) -> List[str]:
+        removed = []  # type: List[str]
+        for file_name in files:
+            file_name = os.path.abspath(file_name)
+            if file_name in self.watches:
+                self.loop.remove(self.watches.pop(file_name))
+                del self.keys[file_name]
+                removed.append(file_name)
+        return removed
+
+    def status(self) -> List[Dict[str, Any]]:
+        documents = []  # type: List[Dict[str, Any]]
+        for file_name, watch in sorted(self.watches.items()):
+            build = watch.build
+            documents.append({
+                'file': file_name,
+                'watching': self.loop.isWatching(watch),
+                'state': self.loop.pool.state(build),
+                'error': None if build.lastError is None
+                else str(build.lastError),
+            })
+        return documents
+
+    def close(self) -> None:
+        self.server.close()
+        try:
+            os.unlink(socketPath())
+        except FileNotFoundError:
+            pass
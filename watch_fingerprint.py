@@ -0,0 +1,109 @@
+import hashlib
+import os
+import re
+from typing import Callable, Dict, List, Optional
+
+# Environments whose contents are taken literally, or handed to something
+# other than TeX, so a % in them isn't a comment.
+_VERBATIM = re.compile(
+    r'\\begin\s*\{(verbatim\*?|Verbatim|BVerbatim|lstlisting|minted|alltt|'
+    r'filecontents\*?|sageblock|sagesilent|sageverbatim|sagecommandline|'
+    r'sageexample)\}')
+# Commands whose arguments are taken literally on the same line.
+_LITERAL_COMMANDS = re.compile(
+    r'\\(verb|lstinline|mintinline|sage|sagestr|sageplot|url|href|path)'
+    r'(?![a-zA-Z])')
+# Everything up to the first % which isn't escaped.
+_TEX_COMMENT = re.compile(r'^((?:[^\\%]|\\.)*%).*$', re.S)
+
+_FENCE = re.compile(r'^ {0,3}(`{3,}|~{3,})')
+# An inline code span, a run of backticks up to the next run of the same
+# length, or an HTML comment.
+_CODE_SPAN_OR_COMMENT = re.compile(r'(`+)(?!`).*?(?<!`)\1(?!`)|<!--.*?-->',
+                                   re.S)
+
+
+def normaliseTeX(text: str) -> str:
+    # Drops what TeX itself ignores: the text of comments, though not the
+    # % which still joins the line to the next, and trailing whitespace.
+    lines = []  # type: List[str]
+    end = None  # type: Optional[str]
+    for line in text.split('\n'):
+        if end is not None:
+            if end in line:
+                end = None
+            lines.append(line)
+            continue
+        match = _VERBATIM.search(line)
+        if match is not None:
+            end = '\\end{' + match.group(1) + '}'
+            if end in line[match.end():]:
+                end = None
+            lines.append(line)
+            continue
+        if _LITERAL_COMMANDS.search(line):
+            lines.append(line)
+            continue
+        lines.append(_TEX_COMMENT.sub(r'\1', line).rstrip())
+    return '\n'.join(lines)
+
+
+def normaliseMarkdown(text: str) -> str:
+    # Drops the text of HTML comments, which pandoc leaves out of every
+    # format but HTML where nobody sees them, and trailing whitespace,
+    # apart from the two spaces which make a line break. Code, whether in
+    # blocks or inline, is left alone.
+    parts = []  # type: List[str]
+    prose = []  # type: List[str]
+
+    def flushProse() -> None:
+        joined = _CODE_SPAN_OR_COMMENT.sub(
+            lambda match: match.group(0) if match.group(1) else '<!---->',
+            '\n'.join(prose))
+        for line in joined.split('\n'):
+            stripped = line.rstrip()
+            if line.endswith('  ') and stripped:
+                stripped += '  '
+            parts.append(stripped)
+        prose.clear()
+
+    fence = ''
+    for line in text.split('\n'):
+        match = _FENCE.match(line)
+        if fence:
+            parts.append(line)
+            if match is not None and match.group(1)[0] == fence[0] and \
+                    len(match.group(1)) >= len(fence):
+                fence = ''
+        elif match is not None:
+            flushProse()
+            fence = match.group(1)
+            parts.append(line)
+        elif line.startswith(('    ', '\t')):
+            # Possibly an indented code block, where whitespace counts.
+            flushProse()
+            parts.append(line)
+        else:
+            prose.append(line)
+    flushProse()
+    return '\n'.join(parts)
+
+
+NORMALISERS = {
+    '.tex': normaliseTeX,
+    '.md': normaliseMarkdown,
+}  # type: Dict[str, Callable[[str], str]]
+
+
+def fingerprint(file_name: str) -> Optional[bytes]:
+    # Returns None for files with no normaliser, and ones which can't be
+    # read as text, whose every byte has to count.
+    normalise = NORMALISERS.get(os.path.splitext(file_name)[1])
+    if normalise is None:
+        return None
+    try:
+        with open(file_name, encoding='utf-8') as fd:
+            text = fd.read()
+    except (OSError, UnicodeDecodeError):
+        return None
+    return hashlib.blake2b(normalise(text).encode()).digest()
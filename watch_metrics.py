@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+
+import glob
+import json
+import os
+import sys
+from typing import List, Tuple, Dict, Any
+
+
+def usage(exit_code: int, name: object) -> None:
+    usage_text = ("Usage: %s [--help|-h]" +
+                  " [metrics.jsonl ...]") % str(name)
+
+    if exit_code == 0:
+        print(usage_text)
+    elif exit_code > 0:
+        print(usage_text, file=sys.stderr)
+    exit(exit_code)
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def readMetrics(file_names: List[str]) -> List[Dict[str, Any]]:
+    records = []  # type: List[Dict[str, Any]]
+    for file_name in file_names:
+        try:
+            fd = open(file_name)
+        except FileNotFoundError:
+            continue
+        with fd:
+            for line in fd:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # A line cut short by a crash; skip it.
+                    continue
+    return records
+
+
+def summarise(records: List[Dict[str, Any]]) -> List[str]:
+    groups = {}  # type: Dict[Tuple[str, str], List[Dict[str, Any]]]
+    for record in records:
+        groups.setdefault(
+            (record['document'], record['step']), []).append(record)
+
+    lines = ['%-30s %-10s %5s %9s %9s %9s %6s' % (
+        'document', 'step', 'runs', 'p50 wall', 'p95 wall', 'p50 cpu',
+        'failed')]
+    for (document, step), group in sorted(groups.items()):
+        walls = [record['wall'] for record in group]
+        cpus = [record['cpu'] for record in group if 'cpu' in record]
+        failed = sum(1 for record in group
+                     if record.get('status', 0) != 0)
+        lines.append('%-30s %-10s %5d %8.2fs %8.2fs %9s %6d' % (
+            document[-30:], step, len(group),
+            percentile(walls, .5), percentile(walls, .95),
+            '%.2fs' % percentile(cpus, .5) if cpus else '-',
+            failed))
+    return lines
+
+
+def main(argv: List[str]) -> None:
+    file_names = []  # type: List[str]
+    for arg in argv[1:]:
+        if arg in ('--help', '-h'):
+            usage(0, os.path.basename(argv[0]))
+        elif arg[0] == '-':
+            print("Invalid argument", file=sys.stderr)
+            usage(1, os.path.basename(argv[0]))
+        else:
+            file_names.append(arg)
+    if not file_names:
+        # Each document has its own auxdir below these by default.
+        for base in ('/tmp/$USER-LaTeX', '/tmp/$USER-Pandoc'):
+            base = os.path.expandvars(base)
+            file_names.append(os.path.join(base, 'metrics.jsonl'))
+            file_names.extend(sorted(
+                glob.glob(os.path.join(base, '*', 'metrics.jsonl'))))
+
+    for line in summarise(readMetrics(file_names)):
+        print(line)
+
+
+if __name__ == '__main__':
+    main(sys.argv)